@@ -0,0 +1,289 @@
+# Replays synthetic update streams against /webhook with a local stand-in for
+# the Bot API and a seeded Postgres, and reports throughput, latency and DB
+# statements per command.
+#
+#   python bench.py --database-url postgresql://localhost/bench_scratch --keys 20000 --updates 2000
+#
+# The database is WIPED before seeding: never point this at a real one.
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+BOT_TOKEN = "0:bench"
+ADMIN = 1
+SCENARIOS = ["use", "guess", "mykey", "genkey", "genkeycsv", "listkeys", "whohas", "stats", "broadcast"]
+
+# === FAKE BOT API ===
+class FakeBotAPI(BaseHTTPRequestHandler):
+    latency = 0.0
+    rate_limited = 0.0
+    replies = defaultdict(list)
+    texts = defaultdict(list)
+    calls = Counter()
+    message_ids = itertools.count(1)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _field(self, body, name):
+        if body[:1] == b"{":
+            return json.loads(body).get(name)
+        match = re.search(rb'name="' + name.encode() + rb'"\r\n\r\n([^\r]*)', body)
+        if match:
+            return match.group(1).decode()
+        return parse_qs(body.decode(errors="ignore")).get(name, [None])[0]
+
+    def _reply(self, payload):
+        out = json.dumps(payload).encode()
+        self.send_response(200 if payload["ok"] else payload["error_code"])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+        if method in ("sendMessage", "createChatInviteLink") and random.random() < self.rate_limited:
+            with self.lock:
+                self.calls["429"] += 1
+            self._reply({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}})
+            return
+        if method == "sendDocument" and b'name="document"; filename=' not in body:
+            # A document that isn't an upload is a file_id, and ours never are.
+            self._reply({"ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier"})
+            return
+        if method in ("sendMessage", "sendDocument", "editMessageText"):
+            chat_id = self._field(body, "chat_id")
+            with self.lock:
+                self.replies[str(chat_id)].append(time.monotonic())
+                self.texts[str(chat_id)].append(self._field(body, "text") or "")
+        if method == "getMe":
+            result = {"id": 2, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("createChatInviteLink", "revokeChatInviteLink"):
+            result = {"invite_link": self._field(body, "invite_link") or f"https://t.me/+bench{next(self.message_ids)}",
+                      "creator": {"id": 2, "is_bot": True, "first_name": "bench"},
+                      "creates_join_request": False, "is_primary": False, "is_revoked": method == "revokeChatInviteLink"}
+        elif method in ("sendMessage", "sendDocument", "editMessageText"):
+            result = {"message_id": next(self.message_ids), "date": 0, "chat": {"id": 1, "type": "private"}}
+        else:
+            result = True
+        self._reply({"ok": True, "result": result})
+
+def serve_api(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeBotAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# === SEEDING ===
+def seed(main, keys, recipients):
+    def fill(cur):
+        cur.execute("TRUNCATE keys, key_channels, aliases, groups, metrics, jobs, job_batches, processed_updates CASCADE")
+        cur.execute("INSERT INTO aliases VALUES ('vip', '-1001'), ('free', '-1002')")
+        cur.execute("INSERT INTO groups VALUES ('all', 'vip'), ('all', 'free')")
+        # Unredeemed keys for /use, then bound ones for /mykey and /broadcast.
+        cur.execute("""
+            INSERT INTO keys (key, duration)
+            SELECT 'BENCH' || lpad(i::text, 7, '0'), interval '30 days' FROM generate_series(1, %s) i
+        """, (keys,))
+        cur.execute("""
+            INSERT INTO keys (key, bound_user, expiry)
+            SELECT 'BOUND' || lpad(i::text, 7, '0'), 10000000 + i, now() + interval '30 days'
+            FROM generate_series(1, %s) i
+        """, (recipients,))
+        cur.execute("INSERT INTO key_channels SELECT key, ch FROM keys, unnest(ARRAY['-1001', '-1002']) ch")
+        cur.execute("ANALYZE")
+    main.db.run_sync(fill)
+
+# === REPLAY ===
+def make_update(update_id, user_id, chat_id, text):
+    command = text.split()[0]
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}}
+
+def scenario_updates(name, n, recipients, update_ids):
+    # Every update gets its own chat so its reply can be told apart; admin
+    # commands keep the admin as sender and only vary the chat.
+    for i in range(n):
+        chat_id = 20000000 + next(update_ids)
+        if name == "use":
+            yield chat_id, make_update(chat_id, chat_id, chat_id, f"/use BENCH{i + 1:07d}")
+        elif name == "guess":
+            # A few users hammering /use with keys that don't exist.
+            user = 50000000 + i % 20
+            yield chat_id, make_update(chat_id, user, chat_id, f"/use GUESS{i:07d}")
+        elif name == "mykey":
+            user = 10000000 + 1 + i % recipients
+            yield chat_id, make_update(chat_id, user, chat_id, "/mykey")
+        elif name == "genkey":
+            yield chat_id, make_update(chat_id, ADMIN, chat_id, "/genkey all 30d 10")
+        elif name == "genkeycsv":
+            # Above GENKEY_INLINE, so the keys come back as a CSV upload.
+            yield chat_id, make_update(chat_id, ADMIN, chat_id, "/genkey all 30d 100")
+        elif name == "listkeys":
+            yield chat_id, make_update(chat_id, ADMIN, chat_id, random.choice(["/listkeys", "/listkeys bound", "/listkeys expiring"]))
+        elif name == "whohas":
+            yield chat_id, make_update(chat_id, ADMIN, chat_id, "/whohas vip")
+        elif name == "stats":
+            yield chat_id, make_update(chat_id, ADMIN, chat_id, "/stats")
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+def replay(main, updates, concurrency, timeout):
+    posted, rejected = {}, Counter()
+    local = threading.local()
+
+    def post(item):
+        chat_id, update = item
+        if not hasattr(local, "client"):
+            local.client = main.app.test_client()
+        posted[str(chat_id)] = time.monotonic()
+        # Telegram redelivers when the webhook answers 503; so do we.
+        while local.client.post("/webhook", json=update).status_code == 503:
+            rejected["503"] += 1
+            time.sleep(0.05)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, updates))
+    # Replies lost to injected 429s never arrive, so stop once they dry up.
+    deadline, answered, progress = time.monotonic() + timeout, -1, time.monotonic()
+    while time.monotonic() < deadline and time.monotonic() - progress < 5:
+        count = sum(1 for c in posted if FakeBotAPI.replies.get(c))
+        if count == len(posted):
+            break
+        if count != answered:
+            answered, progress = count, time.monotonic()
+        time.sleep(0.05)
+    latencies = [FakeBotAPI.replies[c][0] - t for c, t in posted.items() if FakeBotAPI.replies.get(c)]
+    end = max((FakeBotAPI.replies[c][0] for c in posted if FakeBotAPI.replies.get(c)), default=start)
+    return {
+        "sent": len(posted),
+        "answered": len(latencies),
+        "rejected": rejected["503"],
+        "throughput": len(latencies) / max(end - start, 1e-9),
+        "p50": pct(latencies, 0.50),
+        "p99": pct(latencies, 0.99),
+    }
+
+def run_broadcast(main, recipients, timeout):
+    recipient_ids = {str(10000000 + i) for i in range(1, recipients + 1)}
+    chat_id = 30000000
+    start = time.monotonic()
+    main.app.test_client().post("/webhook", json=make_update(chat_id, ADMIN, chat_id, "/broadcast bench"))
+    # The broadcast is a job batch; it is over once the batch is finished.
+    deadline = start + timeout
+    while time.monotonic() < deadline and not main.db.run_sync(lambda cur: (cur.execute(
+            "SELECT COUNT(*) > 0 AND bool_and(finished_at IS NOT NULL) FROM job_batches"), cur.fetchone()[0])[1]):
+        time.sleep(0.1)
+    delivered = [FakeBotAPI.replies[c][-1] for c in recipient_ids if FakeBotAPI.replies.get(c)]
+    elapsed = (max(delivered) - start) if delivered else 0.0
+    return {
+        "sent": recipients,
+        "answered": len(delivered),
+        "rejected": 0,
+        "throughput": len(delivered) / elapsed * 60 if elapsed else 0.0,
+        "p50": 0.0,
+        "p99": elapsed * 1000,
+    }
+
+def run_stress(main, keys, users, concurrency, timeout):
+    # users distinct users race for each of keys keys, sent key by key so the
+    # contenders for one key are in flight together; exactly one may win each.
+    updates, claimants = [], {}
+    for i in range(1, keys + 1):
+        for u in range(users):
+            user = 40000000 + i * users + u
+            claimants[str(user)] = f"BENCH{i:07d}"
+            updates.append((user, make_update(user, user, user, f"/use BENCH{i:07d}")))
+    r = replay(main, updates, concurrency, timeout)
+    winners = defaultdict(set)
+    for user, key in claimants.items():
+        if any("Access granted" in t for t in FakeBotAPI.texts.get(user, [])):
+            winners[key].add(int(user))
+    bound = dict(main.db.run_sync(lambda cur: (cur.execute(
+        "SELECT key, bound_user FROM keys WHERE key = ANY(%s)", (sorted(set(claimants.values())),)), cur.fetchall())[1]))
+    bad = [k for k in bound if bound[k] is None or winners[k] != {bound[k]}]
+    print(f"{len(updates)} redemptions of {keys} keys by {users} users each: "
+          f"{r['answered']} answered, p50 {r['p50']:.1f} ms, p99 {r['p99']:.1f} ms")
+    for k in bad[:10]:
+        print(f"  {k}: bound to {bound[k]}, granted to {sorted(winners[k])}")
+    print("FAIL" if bad else "OK: every key bound exactly once, to the only user granted access")
+    return 1 if bad else 0
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a fake Bot API and a scratch Postgres.")
+    parser.add_argument("--database-url", required=True, help="scratch database, wiped before seeding")
+    parser.add_argument("--keys", type=int, default=10000, help="unredeemed keys to seed")
+    parser.add_argument("--recipients", type=int, default=1000, help="bound users to seed for /mykey and /broadcast")
+    parser.add_argument("--updates", type=int, default=1000, help="updates replayed per command")
+    parser.add_argument("--concurrency", type=int, default=32, help="parallel webhook senders")
+    parser.add_argument("--api-latency", type=float, default=30.0, help="fake Bot API latency in ms")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated commands to run")
+    parser.add_argument("--stress-redeem", type=int, metavar="KEYS",
+                        help="instead of the scenarios, race --stress-users users for each of KEYS keys")
+    parser.add_argument("--stress-users", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for replies per command")
+    args = parser.parse_args()
+
+    os.environ.update(BOT_TOKEN=BOT_TOKEN, ADMIN_USER_ID=str(ADMIN), DATABASE_URL=args.database_url,
+                      TELEGRAM_API_URL=f"http://127.0.0.1:{args.port}/bot", TELEGRAM_HTTP_VERSION="1.1",
+                      PG_NOTIFY="0")
+    FakeBotAPI.latency = args.api_latency / 1000
+    FakeBotAPI.rate_limited = args.rate_limit
+    serve_api(args.port)
+
+    import main
+    main.run_migrations()
+    seed(main, max(args.keys, args.updates, args.stress_redeem or 0), args.recipients)
+    main.start_runtime()
+    if args.stress_redeem:
+        return run_stress(main, args.stress_redeem, args.stress_users, args.concurrency, args.timeout)
+
+    update_ids = itertools.count(1)
+    print(f"{'command':<10} {'sent':>7} {'answered':>8} {'503s':>6} {'per sec':>9} {'p50 ms':>8} {'p99 ms':>9} {'stmts/call':>10}")
+    for name in args.scenarios.split(","):
+        handler = "use" if name == "guess" else name
+        statements, calls = main.telemetry.queries[handler], main.telemetry.calls[handler]
+        if name == "broadcast":
+            r = run_broadcast(main, args.recipients, args.timeout)
+        else:
+            updates = list(scenario_updates(name, args.updates, args.recipients, update_ids))
+            r = replay(main, updates, args.concurrency, args.timeout)
+        calls = main.telemetry.calls[handler] - calls
+        per_call = (main.telemetry.queries[handler] - statements) / calls if calls else 0.0
+        unit = "per min" if name == "broadcast" else ""
+        print(f"{name:<10} {r['sent']:>7} {r['answered']:>8} {r['rejected']:>6} {r['throughput']:>9.1f} "
+              f"{r['p50']:>8.1f} {r['p99']:>9.1f} {per_call:>10.1f} {unit}")
+    errors = dict(main.telemetry.api_errors)
+    print(f"\nBot API calls: {dict(FakeBotAPI.calls)}")
+    print(f"Bot API errors seen by the bot: {errors}")
+    pool = main.db.stats()
+    print(f"/use rejected without a lookup: {dict(main.use_guard.metrics)}")
+    print(f"DB: {pool['queries']} statements, {pool['checkouts']} checkouts, avg wait {pool['avg_wait_ms']:.1f} ms")
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -4,41 +4,1034 @@
 import os
 import csv
 import io
+import gzip
+import tempfile
 import string
-import random
+import secrets
+import time
+import logging
+import threading
+import statistics
+import heapq
+import math
+import hashlib
+from array import array
+import contextvars
+import socket
+import sys
+import argparse
 import psycopg2
-from datetime import datetime, timedelta
-from flask import Flask, request
+import psycopg2.pool
+import psycopg2.extensions
+from psycopg2.extras import Json
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, request
 from dotenv import load_dotenv
-from telegram import Update, Bot
-from telegram.ext import Application, CommandHandler, ContextTypes,
+from telegram import Update, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatJoinRequestHandler, ChatMemberHandler, MessageHandler, ContextTypes, filters
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 import telegram
+import telegram.error
 import asyncio
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_USER_ID"))
-LOCKED = False
-ADMINS = {ADMIN_ID}
 ADMIN_CONTACT = os.getenv("ADMIN_CONTACT")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", 50))
+STARTUP_RETRIES = int(os.getenv("STARTUP_RETRIES", 8))
+STARTUP_BACKOFF = float(os.getenv("STARTUP_BACKOFF", 1))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "2")
 PORT = int(os.environ.get("PORT", 8080))
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 10000))
+DEDUP_DB = os.getenv("DEDUP_DB", "0") == "1"
+DEDUP_TTL = timedelta(hours=int(os.getenv("DEDUP_TTL_HOURS", 24)))
+FANOUT_RATE = float(os.getenv("FANOUT_RATE", 25))
+FANOUT_CHAT_RATE = float(os.getenv("FANOUT_CHAT_RATE", 1))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", 20))
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", 15))
+INVITE_REVOKE_AFTER = int(os.getenv("INVITE_REVOKE_AFTER", 10))
+JOIN_REQUESTS = os.getenv("JOIN_REQUESTS", "0") == "1"
+MEMBER_INDEX = os.getenv("MEMBER_INDEX", "0") == "1"
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", 3600))
+KEY_ARCHIVE = os.getenv("KEY_ARCHIVE", "0") == "1"
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", 5000))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 3600))
+ARCHIVE_RETENTION_MONTHS = int(os.getenv("ARCHIVE_RETENTION_MONTHS", 0))
+JOB_CHUNK = int(os.getenv("JOB_CHUNK", 500))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_BACKOFF = float(os.getenv("JOB_BACKOFF", 5))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", 3600))
+JOB_LEASE = int(os.getenv("JOB_LEASE", 300))
+REMIND_BEFORE = timedelta(days=int(os.getenv("REMIND_BEFORE_DAYS", 3)))
+SCHEDULER_RELOAD = int(os.getenv("SCHEDULER_RELOAD", 3600))
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", 5000))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 50))
+GENKEY_MAX = int(os.getenv("GENKEY_MAX", 100000))
+GENKEY_INLINE = int(os.getenv("GENKEY_INLINE", 50))
+EXPORT_SPOOL = int(os.getenv("EXPORT_SPOOL_MB", 8)) * 1024 * 1024
+IMPORT_BULK_ROWS = int(os.getenv("IMPORT_BULK_ROWS", 100000))
+KEY_FILTER = os.getenv("KEY_FILTER", "1") == "1"
+KEY_FILTER_ERROR = float(os.getenv("KEY_FILTER_ERROR", 0.01))
+KEY_FILTER_RELOAD = int(os.getenv("KEY_FILTER_RELOAD", 3600))
+KEY_FILTER_POLL = float(os.getenv("KEY_FILTER_POLL", 5))
+USE_FAIL_LIMIT = int(os.getenv("USE_FAIL_LIMIT", 10))
+USE_FAIL_WINDOW = int(os.getenv("USE_FAIL_WINDOW", 600))
+USE_GLOBAL_LIMIT = int(os.getenv("USE_GLOBAL_LIMIT", 1000))
+USE_GLOBAL_WINDOW = int(os.getenv("USE_GLOBAL_WINDOW", 10))
+USE_LIMIT_SHARED = os.getenv("USE_LIMIT_SHARED", "0") == "1"
+USE_LIMIT_SYNC = float(os.getenv("USE_LIMIT_SYNC", 1))
+STATS_TTL = int(os.getenv("STATS_TTL", 30))
+METRICS_FLUSH = int(os.getenv("METRICS_FLUSH", 60))
+PG_NOTIFY = os.getenv("PG_NOTIFY", "0") == "1"
+SETTINGS_POLL = int(os.getenv("SETTINGS_POLL", 5))
+ENTITLEMENT_TTL = int(os.getenv("ENTITLEMENT_TTL", 60))
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", 50000))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# === TELEMETRY ===
+# Per-handler latency histograms and DB statement counts, plus Bot API calls
+# and errors by method, rendered in the Prometheus text format on /metrics.
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+class Telemetry:
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.latency = {}
+        self.latency_sum = Counter()
+        self.calls = Counter()
+        self.failures = Counter()
+        self.queries = Counter()
+        self.api_calls = Counter()
+        self.api_errors = Counter()
+
+    def observe(self, handler, seconds, queries, failed):
+        counts = self.latency.setdefault(handler, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                counts[i] += 1
+        self.latency_sum[handler] += seconds
+        self.calls[handler] += 1
+        self.queries[handler] += queries
+        if failed:
+            self.failures[handler] += 1
+
+    def render(self):
+        out = ["# TYPE bot_handler_seconds histogram"]
+        for handler, counts in sorted(self.latency.items()):
+            for bound, n in zip(self.buckets, counts):
+                out.append(f'bot_handler_seconds_bucket{{handler="{handler}",le="{bound}"}} {n}')
+            out.append(f'bot_handler_seconds_bucket{{handler="{handler}",le="+Inf"}} {self.calls[handler]}')
+            out.append(f'bot_handler_seconds_sum{{handler="{handler}"}} {self.latency_sum[handler]:.6f}')
+            out.append(f'bot_handler_seconds_count{{handler="{handler}"}} {self.calls[handler]}')
+        out.append("# TYPE bot_handler_failures_total counter")
+        out += [f'bot_handler_failures_total{{handler="{h}"}} {n}' for h, n in sorted(self.failures.items())]
+        out.append("# TYPE bot_handler_db_statements_total counter")
+        out += [f'bot_handler_db_statements_total{{handler="{h}"}} {n}' for h, n in sorted(self.queries.items())]
+        out.append("# TYPE bot_api_calls_total counter")
+        out += [f'bot_api_calls_total{{method="{m}"}} {n}' for m, n in sorted(self.api_calls.items())]
+        out.append("# TYPE bot_api_errors_total counter")
+        out += [f'bot_api_errors_total{{method="{m}",error="{e}"}} {n}' for (m, e), n in sorted(self.api_errors.items())]
+        out.append("# TYPE bot_jobs_total counter")
+        out += [f'bot_jobs_total{{outcome="{o}"}} {n}' for o, n in sorted(job_queue.metrics.items())]
+        out.append("# TYPE bot_use_rejected_total counter")
+        out += [f'bot_use_rejected_total{{reason="{r}"}} {n}' for r, n in sorted(use_guard.metrics.items())]
+        q, p = update_queue.stats(), db.stats()
+        gauges = {
+            "bot_update_queue_depth": q["depth"],
+            "bot_update_queue_dropped_total": q["dropped"],
+            "bot_update_queue_duplicates_total": q["duplicates"],
+            "bot_db_pool_size": p["size"],
+            "bot_db_pool_in_use": p["in_use"],
+            "bot_db_pool_waiting": p["waiting"],
+            "bot_db_statements_total": p["queries"],
+            "bot_db_errors_total": p["errors"],
+            "bot_scheduled_expiry_events": len(expiry_scheduler.heap),
+            "bot_entitlement_cache_users": len(entitlements.users),
+            "bot_entitlement_cache_hits_total": entitlements.hits,
+            "bot_entitlement_cache_misses_total": entitlements.misses,
+            "bot_key_filter_keys": key_filter.bloom.count if key_filter.bloom else 0,
+        }
+        out += [f"{name} {value}" for name, value in gauges.items()]
+        return "\n".join(out) + "\n"
+
+telemetry = Telemetry()
+
+def instrument(handler, callback):
+    async def wrapper(update, context):
+        stats = Counter()
+        token = current_handler.set(stats)
+        start, failed = time.monotonic(), False
+        try:
+            return await callback(update, context)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            current_handler.reset(token)
+            telemetry.observe(handler, time.monotonic() - start, stats["queries"], failed)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    # Counts every Bot API call, including the ones whose errors handlers swallow.
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        telemetry.api_calls[method] += 1
+        try:
+            return await super().post(url, *args, **kwargs)
+        except telegram.error.TelegramError as e:
+            telemetry.api_errors[method, type(e).__name__] += 1
+            raise
 
 app = Flask(__name__)
-bot = Bot(BOT_TOKEN)
-application = Application.builder().token(BOT_TOKEN).build()
-dispatcher: Dispatcher = application.dispatcher
+application = (Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL)
+               .request(InstrumentedRequest(connection_pool_size=256, http_version=TELEGRAM_HTTP_VERSION))
+               .get_updates_request(InstrumentedRequest(http_version=TELEGRAM_HTTP_VERSION)).build())
+
+# === DATABASE ===
+# Each call checks a connection out of a bounded pool and runs on a dedicated
+# thread pool of the same size, so handlers never block the event loop and
+# queue for a free connection instead of sharing one cursor.
+DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+class CountingCursor(psycopg2.extensions.cursor):
+    statements = 0
+
+    def execute(self, *args, **kwargs):
+        self.statements += 1
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.statements += 1
+        return super().executemany(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        self.statements += 1
+        return super().copy_expert(*args, **kwargs)
+
+class Database:
+    def __init__(self, dsn, minconn=1, maxconn=10):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._ping_conn = None
+        self._ping_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix="db")
+        self.in_use = 0
+        self.waiting = 0
+        self.metrics = {"checkouts": 0, "queries": 0, "errors": 0, "reconnects": 0, "wait_time": 0.0}
+
+    def _checkout(self):
+        with self._lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+            conn = self._pool.getconn()
+            self.in_use += 1
+            self.metrics["checkouts"] += 1
+            return self._pool, conn
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.metrics[name] += n
+
+    def _checkin(self, pool, conn, broken=False):
+        with self._lock:
+            retired = pool in self._retired
+            if conn is not None:
+                pool.putconn(conn, close=broken or retired)
+            if retired and not pool._used:
+                self._retired.discard(pool)
+                pool.closeall()
+
+    def _reset_pool(self, pool):
+        # Other threads may still be using connections of the old pool: it
+        # is only closed once the last of them has been handed back.
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self._retired.add(pool)
+        self._checkin(pool, None)
+
+    def _run(self, fn, *args, stats=None):
+        # fn is run again at most once: after a deadlock or serialization
+        # failure, or when the connection died before the commit was sent.
+        # Once COMMIT is on the wire it may have gone through, so a failure
+        # then is never retried.
+        for attempt in range(2):
+            pool, conn = self._checkout()
+            cur = None
+            committing = False
+            try:
+                with conn.cursor(cursor_factory=CountingCursor) as cur:
+                    result = fn(cur, *args)
+                committing = True
+                conn.commit()
+                return result
+            except Exception as e:
+                self._count("errors")
+                try:
+                    if not conn.closed:
+                        conn.rollback()
+                except DB_ERRORS:
+                    pass
+                retry = not attempt and not committing and (
+                    conn.closed and isinstance(e, DB_ERRORS) or isinstance(e, psycopg2.extensions.TransactionRollbackError))
+                if not retry:
+                    raise
+            finally:
+                with self._lock:
+                    self.in_use -= 1
+                    if cur is not None:
+                        self.metrics["queries"] += cur.statements
+                self._checkin(pool, conn, bool(conn.closed))
+                if cur is not None and stats is not None:
+                    stats["queries"] += cur.statements
+            if conn.closed:
+                # A dead connection usually means the server restarted: every
+                # other idle connection in the pool is stale too.
+                self._count("reconnects")
+                self._reset_pool(pool)
+
+    def ping(self):
+        # Health checks use a connection of their own: a pool that is fully
+        # checked out under load is busy, not down.
+        with self._ping_lock:
+            try:
+                if self._ping_conn is None or self._ping_conn.closed:
+                    self._ping_conn = psycopg2.connect(self.dsn, connect_timeout=5)
+                    self._ping_conn.autocommit = True
+                with self._ping_conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            except DB_ERRORS:
+                if self._ping_conn is not None:
+                    self._ping_conn.close()
+                self._ping_conn = None
+                raise
+
+    def run_sync(self, fn, *args):
+        return self._run(fn, *args)
+
+    async def run(self, fn, *args):
+        queued = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        # Executor threads don't inherit the handler's context, so pass its stats along.
+        stats = current_handler.get()
+
+        def task():
+            with self._lock:
+                self.waiting -= 1
+                self.metrics["wait_time"] += time.monotonic() - queued
+            return self._run(fn, *args, stats=stats)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, task)
+
+    async def execute(self, sql, params=()):
+        def q(cur):
+            cur.execute(sql, params)
+            return cur.rowcount
+        return await self.run(q)
+
+    async def fetchone(self, sql, params=()):
+        def q(cur):
+            cur.execute(sql, params)
+            return cur.fetchone()
+        return await self.run(q)
+
+    async def fetchall(self, sql, params=()):
+        def q(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return await self.run(q)
+
+    def stats(self):
+        pool = self._pool
+        size = len(pool._pool) + len(pool._used) if pool and not pool.closed else 0
+        checkouts = self.metrics["checkouts"] or 1
+        return {
+            "size": size,
+            "max": self.maxconn,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "checkouts": self.metrics["checkouts"],
+            "queries": self.metrics["queries"],
+            "errors": self.metrics["errors"],
+            "reconnects": self.metrics["reconnects"],
+            "avg_wait_ms": self.metrics["wait_time"] * 1000 / checkouts,
+        }
+
+db = Database(os.getenv("DATABASE_URL"), DB_POOL_MIN, DB_POOL_MAX)
+
+# === MIGRATIONS ===
+# Versioned schema changes, applied in order at startup and recorded in
+# schema_migrations. A batched migration is re-run in a fresh transaction
+# until it reports no rows left, so backfills never hold the whole table.
+# The advisory lock keeps several replicas from migrating at once.
+MIGRATION_LOCK = 7311001
+
+def m001_baseline(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, channels TEXT, bound_user INTEGER, expiry TEXT, revoked INTEGER)")
+    cur.execute("ALTER TABLE keys ADD COLUMN IF NOT EXISTS reminded_at TIMESTAMP")
+    cur.execute("CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, channel_id TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS groups (group_name TEXT, alias TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS invite_revocations (invite_link TEXT PRIMARY KEY, chat_id TEXT, revoke_at TIMESTAMP)")
+    cur.execute("CREATE TABLE IF NOT EXISTS eviction_batches (id SERIAL PRIMARY KEY, label TEXT, chat_id BIGINT, message_id BIGINT, "
+                "total INTEGER DEFAULT 0, done INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT now(), finished_at TIMESTAMP)")
+    cur.execute("CREATE TABLE IF NOT EXISTS evictions (id BIGSERIAL PRIMARY KEY, batch_id INTEGER, user_id BIGINT, chat_id TEXT)")
+
+def m002_typed_key_columns(cur):
+    cur.execute("ALTER TABLE keys ADD COLUMN IF NOT EXISTS user_id BIGINT, ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ, "
+                "ADD COLUMN IF NOT EXISTS duration INTERVAL, ADD COLUMN IF NOT EXISTS is_revoked BOOLEAN")
+    cur.execute("CREATE TABLE IF NOT EXISTS key_channels (key TEXT NOT NULL REFERENCES keys(key) ON DELETE CASCADE, "
+                "channel TEXT NOT NULL, PRIMARY KEY (key, channel))")
+
+def m003_backfill_keys(cur):
+    # The old expiry column holds either an ISO timestamp (redeemed keys,
+    # /addkey) or a duration such as "1d2h" (unredeemed /genkey keys).
+    cur.execute("""
+        WITH batch AS (
+            SELECT key FROM keys WHERE is_revoked IS NULL LIMIT %s
+        ), filled AS (
+            UPDATE keys k SET
+                user_id = k.bound_user,
+                is_revoked = COALESCE(k.revoked, 0) <> 0,
+                expires_at = CASE WHEN k.expiry ~ '^[0-9]{4}-' THEN k.expiry::timestamp AT TIME ZONE 'UTC' END,
+                duration = CASE WHEN k.expiry ~ '^[0-9]+[dh]' THEN make_interval(
+                    days => COALESCE(substring(k.expiry from '^([0-9]+)d')::int, 0),
+                    hours => COALESCE(substring(k.expiry from '([0-9]+)h')::int, 0)) END
+            FROM batch WHERE k.key = batch.key
+            RETURNING k.key, k.channels
+        ), linked AS (
+            INSERT INTO key_channels (key, channel)
+            SELECT DISTINCT f.key, ch FROM filled f, unnest(string_to_array(f.channels, '+')) AS ch WHERE ch <> ''
+            ON CONFLICT DO NOTHING
+        )
+        SELECT COUNT(*) FROM filled""", (BACKFILL_BATCH,))
+    return cur.fetchone()[0]
+
+def m004_swap_key_columns(cur):
+    cur.execute("LOCK TABLE keys IN ACCESS EXCLUSIVE MODE")
+    # Rows written by an older replica since the backfill finished.
+    while m003_backfill_keys(cur):
+        pass
+    cur.execute("ALTER TABLE keys DROP COLUMN channels, DROP COLUMN bound_user, DROP COLUMN expiry, DROP COLUMN revoked")
+    cur.execute("ALTER TABLE keys RENAME COLUMN user_id TO bound_user")
+    cur.execute("ALTER TABLE keys RENAME COLUMN expires_at TO expiry")
+    cur.execute("ALTER TABLE keys RENAME COLUMN is_revoked TO revoked")
+    cur.execute("ALTER TABLE keys ALTER COLUMN revoked SET DEFAULT FALSE, ALTER COLUMN revoked SET NOT NULL, "
+                "ALTER COLUMN reminded_at TYPE TIMESTAMPTZ USING reminded_at AT TIME ZONE 'UTC'")
+    cur.execute("ALTER TABLE invite_revocations ALTER COLUMN revoke_at TYPE TIMESTAMPTZ USING revoke_at AT TIME ZONE 'UTC'")
+    cur.execute("ALTER TABLE eviction_batches ALTER COLUMN created_at TYPE TIMESTAMPTZ USING created_at AT TIME ZONE 'UTC', "
+                "ALTER COLUMN finished_at TYPE TIMESTAMPTZ USING finished_at AT TIME ZONE 'UTC'")
+
+def m005_key_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS keys_bound_user_idx ON keys (bound_user) WHERE bound_user IS NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS keys_expiry_idx ON keys (expiry) WHERE NOT revoked AND expiry IS NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS key_channels_channel_idx ON key_channels (channel)")
+
+def m006_groups_primary_key(cur):
+    cur.execute("DELETE FROM groups a USING groups b WHERE a.ctid < b.ctid AND a.group_name = b.group_name AND a.alias = b.alias")
+    cur.execute("DELETE FROM groups WHERE group_name IS NULL OR alias IS NULL")
+    cur.execute("ALTER TABLE groups ADD PRIMARY KEY (group_name, alias)")
+
+def m007_metrics(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT,
+            bucket TIMESTAMPTZ,
+            value BIGINT NOT NULL,
+            PRIMARY KEY (name, bucket)
+        )
+    """)
+
+def m008_settings(cur):
+    # Every write bumps its row's version, so replicas can poll for changes.
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS settings_version")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY,
+            value TEXT,
+            version BIGINT NOT NULL DEFAULT nextval('settings_version')
+        )
+    """)
+    cur.execute("CREATE TABLE IF NOT EXISTS admins (user_id BIGINT PRIMARY KEY)")
+    cur.execute("INSERT INTO settings (name, value) VALUES ('locked', '0'), ('admin_contact', NULL), ('admins', NULL) "
+                "ON CONFLICT DO NOTHING")
+
+def m009_jobs(cur):
+    # The eviction and invite revocation queues become kinds of job; batches
+    # now track any fan-out, not just evictions.
+    cur.execute("ALTER TABLE eviction_batches RENAME TO job_batches")
+    cur.execute("""
+        CREATE TABLE jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            batch_id INTEGER,
+            run_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            dead BOOLEAN NOT NULL DEFAULT FALSE,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("CREATE INDEX jobs_due_idx ON jobs (run_at) WHERE NOT dead")
+    cur.execute("INSERT INTO jobs (kind, payload, batch_id) "
+                "SELECT 'evict', jsonb_build_object('user_id', user_id, 'chat_id', chat_id), batch_id FROM evictions ORDER BY id")
+    cur.execute("INSERT INTO jobs (kind, payload, run_at) "
+                "SELECT 'revoke_link', jsonb_build_object('chat_id', chat_id, 'invite_link', invite_link), revoke_at FROM invite_revocations")
+    cur.execute("DROP TABLE evictions, invite_revocations")
+
+def m010_processed_updates(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS processed_updates (update_id BIGINT PRIMARY KEY, "
+                "seen_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+
+def m011_use_attempts(cur):
+    # Only shared /use throttling counts live here; losing them in a crash is fine.
+    cur.execute("CREATE UNLOGGED TABLE IF NOT EXISTS use_attempts (scope TEXT, bucket BIGINT, hits INTEGER NOT NULL, "
+                "PRIMARY KEY (scope, bucket))")
+
+def m012_channel_links(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS channel_links (channel TEXT PRIMARY KEY, invite_link TEXT NOT NULL, "
+                "created_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+
+def m013_channel_members(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS member_channels (chat_id BIGINT PRIMARY KEY, username TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS channel_members (chat_id BIGINT REFERENCES member_channels, user_id BIGINT, "
+                "status TEXT NOT NULL, joined_at TIMESTAMPTZ NOT NULL DEFAULT now(), PRIMARY KEY (chat_id, user_id))")
+    cur.execute("CREATE INDEX IF NOT EXISTS channel_members_user_idx ON channel_members (user_id)")
+
+def m014_key_archive(cur):
+    # Partitions are created per month of archived_at as rows arrive.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS key_archive (
+            key TEXT NOT NULL,
+            channels TEXT[] NOT NULL,
+            bound_user BIGINT,
+            expiry TIMESTAMPTZ,
+            duration INTERVAL,
+            revoked BOOLEAN NOT NULL,
+            reminded_at TIMESTAMPTZ,
+            archived_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (key, archived_at)
+        ) PARTITION BY RANGE (archived_at)
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS key_archive_channels_idx ON key_archive USING gin (channels)")
+
+def m015_batch_blocked(cur):
+    cur.execute("ALTER TABLE job_batches ADD COLUMN IF NOT EXISTS blocked INTEGER NOT NULL DEFAULT 0")
+
+def m016_member_seed(cur):
+    cur.execute("ALTER TABLE member_channels ADD COLUMN IF NOT EXISTS seed_batch INTEGER")
+
+MIGRATIONS = [
+    (1, "baseline", m001_baseline, False),
+    (2, "typed key columns", m002_typed_key_columns, False),
+    (3, "backfill keys", m003_backfill_keys, True),
+    (4, "swap key columns", m004_swap_key_columns, False),
+    (5, "key indexes", m005_key_indexes, False),
+    (6, "groups primary key", m006_groups_primary_key, False),
+    (7, "metrics", m007_metrics, False),
+    (8, "settings", m008_settings, False),
+    (9, "jobs", m009_jobs, False),
+    (10, "processed updates", m010_processed_updates, False),
+    (11, "use attempts", m011_use_attempts, False),
+    (12, "channel links", m012_channel_links, False),
+    (13, "channel members", m013_channel_members, False),
+    (14, "key archive", m014_key_archive, False),
+    (15, "batch blocked count", m015_batch_blocked, False),
+    (16, "member index seeding", m016_member_seed, False),
+]
+
+def _apply_migration(cur, version, name, fn, batched):
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+    cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+    if cur.fetchone():
+        return False
+    if fn(cur) and batched:
+        return True
+    cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+    logger.info("Applied migration %s (%s)", version, name)
+    return False
+
+def run_migrations():
+    db.run_sync(lambda cur: cur.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"))
+    for version, name, fn, batched in MIGRATIONS:
+        while db.run_sync(_apply_migration, version, name, fn, batched):
+            pass
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+def format_time(dt):
+    return dt.strftime('%Y-%m-%d %H:%M') + " UTC"
+
+def format_duration(td):
+    hours = td.seconds // 3600
+    if not td.days:
+        return f"{hours}h"
+    return f"{td.days}d{hours}h" if hours else f"{td.days}d"
+
+def format_expiry(expiry, duration=None, lifetime="💎 Lifetime"):
+    if expiry:
+        return format_time(expiry)
+    if duration:
+        return f"{format_duration(duration)} from redemption"
+    return lifetime
+
+# All of a key's channels, "+"-joined as they used to be stored.
+KEY_CHANNELS = "(SELECT string_agg(c.channel, '+' ORDER BY c.channel) FROM key_channels c WHERE c.key = k.key)"
+# The CSV layout of /exportkeys and the backups: unredeemed keys keep their duration.
+EXPORT_KEYS = (f"SELECT k.key, {KEY_CHANNELS}, k.bound_user, "
+               f"COALESCE(to_char(k.expiry AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS'), "
+               f"extract(day FROM k.duration)::int || 'd' || extract(hour FROM k.duration)::int || 'h'), "
+               f"k.revoked::int FROM keys k")
+
+def insert_key(cur, key, channels, expiry=None, duration=None):
+    cur.execute("INSERT INTO keys (key, expiry, duration) VALUES (%s, %s, %s)", (key, expiry, duration))
+    cur.executemany("INSERT INTO key_channels (key, channel) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                    [(key, ch) for ch in channels if ch])
+
+# === CROSS-REPLICA NOTIFICATIONS ===
+# With PG_NOTIFY=1 every replica keeps one extra connection LISTENing on the
+# channels that caches subscribe to; writers pg_notify() after committing.
+# Callbacks get the data published with the notification, or None after a
+# (re)connect when notifications may have been missed.
+class PgListener:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.callbacks = {}
+
+    def subscribe(self, channel, callback):
+        self.callbacks[channel] = callback
+
+    async def publish(self, channel, data=""):
+        if PG_NOTIFY:
+            await db.execute("SELECT pg_notify(%s, %s)", (channel, f"{INSTANCE_ID}|{data}"))
+
+    async def _dispatch(self, channel, payload):
+        try:
+            await self.callbacks[channel](payload)
+        except Exception:
+            logger.exception("Notification handler for %s failed", channel)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn = None
+            try:
+                conn = await asyncio.to_thread(psycopg2.connect, self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    for channel in self.callbacks:
+                        cur.execute(f"LISTEN {channel}")
+                for channel in self.callbacks:
+                    await self._dispatch(channel, None)
+                readable = asyncio.Event()
+                loop.add_reader(conn.fileno(), readable.set)
+                try:
+                    while True:
+                        try:
+                            await asyncio.wait_for(readable.wait(), 60)
+                        except asyncio.TimeoutError:
+                            with conn.cursor() as cur:
+                                cur.execute("SELECT 1")
+                        readable.clear()
+                        conn.poll()
+                        while conn.notifies:
+                            n = conn.notifies.pop(0)
+                            sender, _, data = n.payload.partition("|")
+                            if sender != INSTANCE_ID:
+                                await self._dispatch(n.channel, data)
+                finally:
+                    loop.remove_reader(conn.fileno())
+            except Exception:
+                logger.exception("Notification listener disconnected")
+            finally:
+                if conn is not None:
+                    conn.close()
+            await asyncio.sleep(5)
+
+pg_listener = PgListener(os.getenv("DATABASE_URL"))
+
+# === ALIAS CACHE ===
+# Aliases and groups change rarely but are read by every /genkey and
+# /whohas, so both maps live in memory. Commands that change them call
+# invalidate() after their write, which reloads this replica and notifies
+# the others.
+class AliasCache:
+    channel = "alias_cache"
+
+    def __init__(self):
+        self.aliases = {}
+        self.groups = {}
+        self.loaded = False
+
+    @staticmethod
+    def _load(cur):
+        cur.execute("SELECT alias, channel_id FROM aliases ORDER BY alias")
+        aliases = dict(cur.fetchall())
+        cur.execute("SELECT group_name, alias FROM groups ORDER BY group_name, alias")
+        groups = {}
+        for g, a in cur.fetchall():
+            groups.setdefault(g, []).append(a)
+        return aliases, groups
+
+    async def refresh(self, payload=None):
+        self.aliases, self.groups = await db.run(self._load)
+        self.loaded = True
+
+    async def invalidate(self):
+        await self.refresh()
+        await pg_listener.publish(self.channel)
+
+    async def ensure(self):
+        if not self.loaded:
+            await self.refresh()
+
+    async def expand(self, value):
+        # A group name expands to its aliases, anything else is a "+"-list.
+        await self.ensure()
+        return list(self.groups.get(value) or value.split("+"))
+
+    async def resolve(self, value):
+        return [self.aliases.get(a, a) for a in await self.expand(value)]
+
+alias_cache = AliasCache()
+pg_listener.subscribe(AliasCache.channel, alias_cache.refresh)
+
+# === SETTINGS ===
+# Admins, the lock and the admin contact live in Postgres and are cached here.
+# Replicas pick up changes through PG_NOTIFY when enabled, otherwise by
+# polling the row versions every SETTINGS_POLL seconds.
+class Settings:
+    channel = "settings"
+
+    def __init__(self):
+        self.admins = {ADMIN_ID}
+        self.locked = False
+        self.admin_contact = ADMIN_CONTACT
+        self.versions = None
+
+    @staticmethod
+    def _load(cur):
+        cur.execute("SELECT name, value, version FROM settings ORDER BY name")
+        rows = cur.fetchall()
+        cur.execute("SELECT user_id FROM admins")
+        return rows, {r[0] for r in cur.fetchall()}
+
+    async def refresh(self, payload=None):
+        rows, admins = await db.run(self._load)
+        values = {name: value for name, value, _ in rows}
+        self.admins = admins | {ADMIN_ID}
+        self.locked = values.get("locked") == "1"
+        self.admin_contact = values.get("admin_contact") or ADMIN_CONTACT
+        self.versions = [v for _, _, v in rows]
+
+    async def _changed(self):
+        await self.refresh()
+        await pg_listener.publish(self.channel)
+
+    async def set(self, name, value):
+        await db.execute("UPDATE settings SET value = %s, version = nextval('settings_version') WHERE name = %s",
+                         (value, name))
+        await self._changed()
+
+    async def set_admin(self, uid, admin):
+        def write(cur):
+            if admin:
+                cur.execute("INSERT INTO admins VALUES (%s) ON CONFLICT DO NOTHING", (uid,))
+            else:
+                cur.execute("DELETE FROM admins WHERE user_id = %s", (uid,))
+            cur.execute("UPDATE settings SET version = nextval('settings_version') WHERE name = 'admins'")
+        await db.run(write)
+        await self._changed()
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(SETTINGS_POLL)
+            try:
+                row = await db.fetchone("SELECT array_agg(version ORDER BY name) FROM settings")
+                if row[0] != self.versions:
+                    await self.refresh()
+            except Exception:
+                logger.exception("Settings poll failed")
+
+settings = Settings()
+pg_listener.subscribe(Settings.channel, settings.refresh)
+
+# === ENTITLEMENT CACHE ===
+# Each user's keys, as /mykey and repeat /use calls see them, cached for
+# ENTITLEMENT_TTL seconds in a bounded LRU. Anything that changes a bound
+# key invalidates its users here and, with PG_NOTIFY, on every replica.
+ENTITLEMENTS_SQL = f"""
+    SELECT k.key, k.expiry, {KEY_CHANNELS}, k.revoked FROM keys k
+    WHERE k.bound_user = %s ORDER BY k.revoked, k.expiry DESC NULLS FIRST
+"""
+
+class EntitlementCache:
+    channel = "entitlements"
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.users = OrderedDict()
+        self.hits = self.misses = 0
+
+    def _fresh(self, user_id):
+        entry = self.users.get(user_id)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            self.users.move_to_end(user_id)
+            return entry[1]
+        return None
 
-conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-cur = conn.cursor()
-cur.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, channels TEXT, bound_user INTEGER, expiry TEXT, revoked INTEGER)")
-cur.execute("CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, channel_id TEXT)")
-cur.execute("CREATE TABLE IF NOT EXISTS groups (group_name TEXT, alias TEXT)")
-conn.commit()
+    def peek(self, user_id, key):
+        # Never touches the DB: only answers for users already cached.
+        held = next((r for r in self._fresh(user_id) or () if r[0] == key), None)
+        if held:
+            self.hits += 1
+        return held
+
+    async def get(self, user_id):
+        rows = self._fresh(user_id)
+        if rows is not None:
+            self.hits += 1
+            return rows
+        self.misses += 1
+        rows = await db.fetchall(ENTITLEMENTS_SQL, (user_id,))
+        self.users[user_id] = (time.monotonic(), rows)
+        self.users.move_to_end(user_id)
+        while len(self.users) > self.size:
+            self.users.popitem(last=False)
+        return rows
+
+    def _drop(self, data):
+        if not data or data == "*":
+            self.users.clear()
+            return
+        for uid in data.split(","):
+            self.users.pop(int(uid), None)
+
+    async def receive(self, data):
+        self._drop(data)
+
+    async def invalidate(self, user_ids):
+        user_ids = [u for u in user_ids if u]
+        if not user_ids:
+            return
+        # NOTIFY payloads are capped at 8000 bytes.
+        data = ",".join(map(str, user_ids)) if len(user_ids) <= 400 else "*"
+        self._drop(data)
+        await pg_listener.publish(self.channel, data)
+
+    async def clear(self):
+        self._drop("*")
+        await pg_listener.publish(self.channel, "*")
+
+entitlements = EntitlementCache(ENTITLEMENT_TTL, ENTITLEMENT_CACHE_SIZE)
+pg_listener.subscribe(EntitlementCache.channel, entitlements.receive)
+
+# === KEY FILTER ===
+# A Bloom filter of every key lets /use turn away keys that certainly don't
+# exist without a query. It may only ever err towards "maybe": keys created
+# here go straight in, other replicas hear about them over pg_notify (a "*"
+# or a lost connection means rebuild), and the whole filter is rebuilt from
+# the table every KEY_FILTER_RELOAD seconds, which also resizes it as the
+# table grows. Until a build has finished every key is a "maybe". Without
+# PG_NOTIFY the insert counter of keys is polled instead, and inserts this
+# replica didn't make itself (another replica, the importkeys CLI) trigger
+# a rebuild. Keys made elsewhere can then be missing for up to
+# KEY_FILTER_POLL seconds, so a miss only turns a user away without a
+# lookup once they are halfway to USE_FAIL_LIMIT.
+KEY_INSERTS_SQL = ("SELECT n_tup_ins, current_setting('track_counts') = 'on' "
+                   "FROM pg_stat_user_tables WHERE relid = 'keys'::regclass")
+
+class BloomFilter:
+    # Blocked layout: a key's seven bits all land in one 64-bit word, so
+    # adding or testing a key is one hash and one word operation. That costs
+    # a little accuracy for a build several times faster in Python.
+    def __init__(self, capacity, error):
+        self.capacity = capacity
+        self.words = array("Q", bytes(8 * (int(-capacity * math.log(error) / math.log(2) ** 2) // 64 + 1)))
+        self.count = 0
+
+    def _locate(self, item):
+        d = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        mask = ((1 << (d[8] & 63)) | (1 << (d[9] & 63)) | (1 << (d[10] & 63)) | (1 << (d[11] & 63))
+                | (1 << (d[12] & 63)) | (1 << (d[13] & 63)) | (1 << (d[14] & 63)))
+        return int.from_bytes(d[:8], "little") % len(self.words), mask
+
+    def add(self, item):
+        word, mask = self._locate(item)
+        self.words[word] |= mask
+        self.count += 1
+
+    def __contains__(self, item):
+        word, mask = self._locate(item)
+        return self.words[word] & mask == mask
+
+class KeyFilter:
+    channel = "key_filter"
+
+    def __init__(self, error, reload):
+        self.error = error
+        self.reload = reload
+        self.bloom = None
+        self.stale = False
+        self.pending = None
+        self.inserts = None
+        self.local = 0
+
+    @staticmethod
+    def _load(cur, error):
+        cur.execute(KEY_INSERTS_SQL)
+        inserts = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM keys")
+        bloom = BloomFilter(max(100000, 2 * cur.fetchone()[0]), error)
+        with cur.connection.cursor("key_filter") as keys:
+            keys.itersize = 50000
+            keys.execute("SELECT key FROM keys")
+            for (key,) in keys:
+                bloom.add(key)
+        return bloom, inserts
+
+    async def rebuild(self, payload=None):
+        self.stale = True
+        if self.pending is not None:
+            # The build already running goes round once more.
+            return
+        self.pending = []
+        try:
+            while self.stale:
+                self.stale = False
+                bloom, self.inserts = await db.run(self._load, self.error)
+                self.local = 0
+            for key in self.pending:
+                bloom.add(key)
+            self.bloom = bloom
+        except Exception:
+            # A filter that may be missing keys is worse than none.
+            self.bloom = None
+            logger.exception("Key filter rebuild failed")
+        finally:
+            self.pending = None
+
+    def add(self, keys):
+        self.local += len(keys)
+        if self.pending is not None:
+            self.pending.extend(keys)
+        if self.bloom is not None:
+            for key in keys:
+                self.bloom.add(key)
+            if self.bloom.count > self.bloom.capacity:
+                asyncio.create_task(self.rebuild())
+
+    async def added(self, keys):
+        self.add(keys)
+        # Keys never contain spaces: they arrive as command arguments.
+        data = " ".join(keys)
+        await pg_listener.publish(self.channel, data if len(data) < 7000 else "*")
+
+    async def invalidate(self):
+        # Only a replica that has built a filter needs to rebuild it.
+        if self.bloom is not None or self.pending is not None:
+            await self.rebuild()
+        await pg_listener.publish(self.channel, "*")
+
+    async def receive(self, data):
+        if not data or data == "*":
+            await self.rebuild()
+        else:
+            self.add(data.split(" "))
+
+    def might_exist(self, key):
+        return self.bloom is None or key in self.bloom
+
+    async def run(self):
+        while True:
+            await self.rebuild()
+            await asyncio.sleep(self.reload)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(KEY_FILTER_POLL)
+            try:
+                inserts, tracked = await db.fetchone(KEY_INSERTS_SQL)
+                if not tracked:
+                    # Nothing would tell us about other replicas' keys.
+                    if self.bloom is not None:
+                        logger.warning("track_counts is off: key filter disabled without PG_NOTIFY")
+                    self.bloom = None
+                    continue
+                if self.inserts is None or self.pending is not None:
+                    continue
+                # Our own inserts can show up in the counter a poll or two
+                # late, so they stay credited until they do.
+                foreign = inserts - self.inserts - self.local
+                reset = inserts < self.inserts
+                self.inserts, self.local = inserts, max(0, -foreign)
+                if foreign > 0 or reset:
+                    await self.rebuild()
+            except Exception:
+                logger.exception("Key filter poll failed")
+
+key_filter = KeyFilter(KEY_FILTER_ERROR, KEY_FILTER_RELOAD)
+pg_listener.subscribe(KeyFilter.channel, key_filter.receive)
+
+KEY_ALPHABET = string.ascii_uppercase + string.digits
+# Maps random bytes onto the alphabet; bytes past the last full multiple of
+# its length are dropped so every character stays equally likely.
+KEY_BYTES = bytes(ord(KEY_ALPHABET[b % len(KEY_ALPHABET)]) for b in range(256))
+KEY_REJECT = bytes(range(256 - 256 % len(KEY_ALPHABET), 256))
+
+def gen_random_keys(count, length=12):
+    chars = b""
+    while len(chars) < count * length:
+        chars += secrets.token_bytes(count * length + 64).translate(KEY_BYTES, KEY_REJECT)
+    text = chars.decode()
+    return [text[i * length:(i + 1) * length] for i in range(count)]
 
 def gen_random_key(length=12):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+    return gen_random_keys(1, length)[0]
+
+def insert_random_keys(cur, count, channels, duration=None):
+    # Collisions are skipped by ON CONFLICT and topped up in the next round,
+    # so one duplicate never aborts the whole batch.
+    created = []
+    while len(created) < count:
+        cur.execute("""
+            WITH ins AS (
+                INSERT INTO keys (key, duration)
+                SELECT k, %s FROM unnest(%s::text[]) k ORDER BY k
+                ON CONFLICT DO NOTHING RETURNING key
+            ), chans AS (
+                INSERT INTO key_channels (key, channel)
+                SELECT ins.key, ch FROM ins, unnest(%s::text[]) ch
+                ON CONFLICT DO NOTHING
+            )
+            SELECT key FROM ins
+        """, (duration, list(set(gen_random_keys(count - len(created)))), [ch for ch in channels if ch]))
+        created += [r[0] for r in cur.fetchall()]
+    return created
 
 def parse_duration(s):
     if s.lower() in ("l", "lifetime"):
@@ -57,12 +1050,1426 @@ def parse_duration(s):
 def home():
     return "✅ Bot is alive!"
 
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(telemetry.render(), mimetype="text/plain; version=0.0.4")
+
+# === UPDATE DEDUPLICATION ===
+# Telegram redelivers an update whenever the webhook is slow to answer, so
+# recent update_ids are remembered and repeats are acknowledged without being
+# processed. The in-memory window only covers this replica; with DEDUP_DB=1
+# every update_id is also claimed in processed_updates, which replicas share.
+class UpdateDedup:
+    def __init__(self, size, use_db, ttl):
+        self.size = size
+        self.use_db = use_db
+        self.ttl = ttl
+        self.seen = OrderedDict()
+
+    @staticmethod
+    def _claim(cur, update_id):
+        cur.execute("INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING", (update_id,))
+        return cur.rowcount == 1
+
+    async def claim(self, update_id):
+        if update_id in self.seen:
+            self.seen.move_to_end(update_id)
+            return False
+        self.seen[update_id] = None
+        if len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        try:
+            return not self.use_db or await db.run(self._claim, update_id)
+        except Exception:
+            # Unclaimed: the redelivery must not look like a repeat.
+            self.seen.pop(update_id, None)
+            raise
+
+    async def release(self, update_id):
+        # For updates we turned away, so the redelivery is processed.
+        self.seen.pop(update_id, None)
+        if self.use_db:
+            await db.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+
+    async def run(self):
+        # Telegram gives up redelivering after a day, so older claims can go.
+        while True:
+            try:
+                await db.execute("DELETE FROM processed_updates WHERE seen_at < now() - %s", (self.ttl,))
+            except Exception:
+                logger.exception("Pruning processed updates failed")
+            await asyncio.sleep(3600)
+
+update_dedup = UpdateDedup(DEDUP_WINDOW, DEDUP_DB, DEDUP_TTL)
+
+# === UPDATE QUEUE ===
+# Flask threads only hand updates over to one long-lived event loop, where a
+# fixed pool of workers drains a bounded queue. When the queue is full the
+# webhook answers 503 so Telegram backs off and redelivers later.
+# Updates from one chat are processed one at a time and in order: a worker
+# that picks up an update for a chat another worker is busy with parks it in
+# that chat's lane, and the busy worker drains the lane before moving on.
+# Different chats still run in parallel.
+class UpdateQueue:
+    def __init__(self, maxsize=1000, workers=8):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.lanes = {}
+        self.parked = 0
+        self.latencies = deque(maxlen=1000)
+        self.metrics = {"received": 0, "processed": 0, "dropped": 0, "duplicates": 0, "errors": 0}
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def depth(self):
+        return (self.queue.qsize() if self.queue else 0) + self.parked
+
+    async def submit(self, update):
+        self.metrics["received"] += 1
+        if self.depth() >= self.maxsize:
+            self.metrics["dropped"] += 1
+            return False
+        if not await update_dedup.claim(update.update_id):
+            self.metrics["duplicates"] += 1
+            return True
+        if self.depth() >= self.maxsize:
+            await update_dedup.release(update.update_id)
+            self.metrics["dropped"] += 1
+            return False
+        self.queue.put_nowait((update, time.monotonic()))
+        return True
+
+    @staticmethod
+    def chat_key(update):
+        chat = update.effective_chat or update.effective_user
+        return chat.id if chat else None
+
+    async def _process(self, update, queued):
+        try:
+            await application.process_update(update)
+            self.metrics["processed"] += 1
+        except Exception:
+            self.metrics["errors"] += 1
+            logger.exception("Update %s failed", update.update_id)
+        finally:
+            self.latencies.append(time.monotonic() - queued)
+
+    async def _worker(self):
+        while True:
+            update, queued = await self.queue.get()
+            self.queue.task_done()
+            key = self.chat_key(update)
+            if key in self.lanes:
+                self.lanes[key].append((update, queued))
+                self.parked += 1
+                continue
+            if key is None:
+                await self._process(update, queued)
+                continue
+            lane = self.lanes[key] = deque()
+            try:
+                await self._process(update, queued)
+                while lane:
+                    self.parked -= 1
+                    await self._process(*lane.popleft())
+            finally:
+                del self.lanes[key]
+
+    def stats(self):
+        lat = sorted(self.latencies)
+        pct = lambda p: lat[min(len(lat) - 1, int(len(lat) * p))] * 1000 if lat else 0.0
+        return {
+            "depth": self.depth(),
+            "busy_chats": len(self.lanes),
+            "max": self.maxsize,
+            "workers": self.workers,
+            **self.metrics,
+            "p50_ms": pct(0.50),
+            "p99_ms": pct(0.99),
+            "mean_ms": statistics.fmean(lat) * 1000 if lat else 0.0,
+        }
+
+update_queue = UpdateQueue(WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS)
+
+# === POLLING ===
+# With BOT_MODE=polling (no public WEBHOOK_URL) updates are long-polled from
+# getUpdates and fed into the same update queue, so deduplication, per-chat
+# ordering and back-pressure behave exactly as with the webhook. The offset
+# only moves past an update once the queue has taken it.
+async def poll_updates():
+    await application.bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await application.bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, read_timeout=POLL_TIMEOUT + 10,
+                                                         allowed_updates=Update.ALL_TYPES if MEMBER_INDEX else None)
+        except telegram.error.RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except telegram.error.TelegramError as e:
+            logger.warning("getUpdates failed: %s", e)
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            while True:
+                try:
+                    if await update_queue.submit(update):
+                        break
+                except Exception:
+                    logger.exception("Queueing update %s failed", update.update_id)
+                await asyncio.sleep(1)
+            offset = update.update_id + 1
+
+# === STARTUP ===
+# Importing main does no I/O. start_runtime() runs migrations, the Bot API
+# handshake and the initial cache loads on a startup thread, retrying with
+# exponential backoff so a database or API that is briefly unreachable delays
+# readiness instead of killing the process. Until it is ready the webhook
+# answers 503 straight away, and Telegram redelivers later.
+loop = asyncio.new_event_loop()
+background_tasks = []
+_runtime_lock = threading.Lock()
+_runtime_state = "idle"
+_startup_thread = None
+_loop_thread = None
+
+def with_retries(label, fn):
+    for attempt in range(1, STARTUP_RETRIES + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == STARTUP_RETRIES:
+                raise
+            delay = min(STARTUP_BACKOFF * 2 ** (attempt - 1), 30)
+            logger.warning("%s failed (%s), retrying in %.1fs", label, e, delay)
+            time.sleep(delay)
+
+def on_loop(coro):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+async def _load_state():
+    await application.initialize()
+    await alias_cache.refresh()
+    await settings.refresh()
+    if MEMBER_INDEX and BOT_MODE != "polling":
+        await request_member_updates()
+
+async def _start_bot():
+    update_queue.start()
+    background_tasks.append(asyncio.create_task(job_queue.run()))
+    background_tasks.append(asyncio.create_task(expiry_scheduler.run()))
+    background_tasks.append(asyncio.create_task(metrics.run()))
+    if KEY_FILTER:
+        background_tasks.append(asyncio.create_task(key_filter.run()))
+        if not PG_NOTIFY:
+            background_tasks.append(asyncio.create_task(key_filter.poll()))
+    if USE_LIMIT_SHARED:
+        background_tasks.append(asyncio.create_task(use_guard.run()))
+    if DEDUP_DB:
+        background_tasks.append(asyncio.create_task(update_dedup.run()))
+    if MEMBER_INDEX:
+        background_tasks.append(asyncio.create_task(member_reconciler.run()))
+    if KEY_ARCHIVE:
+        background_tasks.append(asyncio.create_task(key_archiver.run()))
+    if PG_NOTIFY:
+        background_tasks.append(asyncio.create_task(pg_listener.run()))
+    else:
+        background_tasks.append(asyncio.create_task(settings.poll()))
+    if BOT_MODE == "polling":
+        background_tasks.append(asyncio.create_task(poll_updates()))
+
+def _startup():
+    global _runtime_state, _loop_thread
+    try:
+        if _loop_thread is None:
+            _loop_thread = threading.Thread(target=loop.run_forever, name="bot-loop", daemon=True)
+            _loop_thread.start()
+        with_retries("Migrations", run_migrations)
+        with_retries("Startup", lambda: on_loop(_load_state()))
+        on_loop(_start_bot())
+        _runtime_state = "ready"
+        logger.info("Bot ready (%s mode)", BOT_MODE)
+    except Exception:
+        logger.exception("Startup failed")
+        _runtime_state = "failed"
+
+def start_runtime(wait=True):
+    # Idempotent; a failed startup is attempted again on the next call.
+    global _runtime_state, _startup_thread
+    with _runtime_lock:
+        if _runtime_state in ("idle", "failed"):
+            _runtime_state = "starting"
+            _startup_thread = threading.Thread(target=_startup, name="startup", daemon=True)
+            _startup_thread.start()
+    if wait:
+        _startup_thread.join()
+        if _runtime_state != "ready":
+            raise RuntimeError("Bot failed to start")
+    return _runtime_state == "ready"
+
+@app.route("/healthz")
+def healthz():
+    # Liveness: the event loop still answers. A failed startup is also
+    # reported here, so the supervisor restarts the process.
+    if _runtime_state == "failed":
+        return "Startup failed", 500
+    if _loop_thread is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(timeout=5)
+        except Exception:
+            return "Event loop stalled", 500
+    return "OK"
+
+@app.route("/readyz")
+def readyz():
+    # Readiness: started, the database answers and the update queue has room.
+    if _runtime_state != "ready":
+        return _runtime_state.capitalize(), 503
+    if update_queue.depth() >= update_queue.maxsize:
+        return "Update queue full", 503
+    try:
+        db.ping()
+    except Exception:
+        return "Database unavailable", 503
+    return "Ready"
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    update = telegram.Update.de_json(request.get_json(force=True), bot)
-    asyncio.run(dispatcher.process_update(update))
+    if not start_runtime(wait=False):
+        return "Starting", 503
+    update = Update.de_json(request.get_json(force=True), application.bot)
+    accepted = asyncio.run_coroutine_threadsafe(update_queue.submit(update), loop).result()
+    if not accepted:
+        return "Busy", 503
     return "OK"
 
+# === METRICS ===
+# Event counters are bucketed by hour in memory and added onto the metrics
+# table every METRICS_FLUSH seconds, so replicas can flush the same bucket.
+STATS_SQL = """
+    SELECT COUNT(*), COUNT(*) FILTER (WHERE NOT revoked), COUNT(*) FILTER (WHERE revoked),
+           COUNT(DISTINCT bound_user),
+           COUNT(DISTINCT bound_user) FILTER (WHERE NOT revoked AND (expiry IS NULL OR expiry > now())),
+           (SELECT COUNT(*) FROM aliases), (SELECT COUNT(DISTINCT group_name) FROM groups)
+    FROM keys
+"""
+
+def sparkline(values):
+    top = max(values) or 1
+    return "".join("▁▂▃▄▅▆▇█"[round(v / top * 7)] for v in values)
+
+class Metrics:
+    def __init__(self):
+        self.pending = Counter()
+        self.snapshot_at = None
+        self.snapshot = None
+
+    def incr(self, name, n=1):
+        if n:
+            bucket = utcnow().replace(minute=0, second=0, microsecond=0)
+            self.pending[name, bucket] += n
+
+    async def flush(self):
+        pending, self.pending = self.pending, Counter()
+        if not pending:
+            return
+        try:
+            await db.run(lambda cur: cur.executemany("""
+                INSERT INTO metrics (name, bucket, value) VALUES (%s, %s, %s)
+                ON CONFLICT (name, bucket) DO UPDATE SET value = metrics.value + EXCLUDED.value
+            """, [(name, bucket, n) for (name, bucket), n in pending.items()]))
+        except Exception:
+            self.pending.update(pending)
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(METRICS_FLUSH)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Metrics flush failed")
+
+    @staticmethod
+    def _load(cur):
+        cur.execute(STATS_SQL)
+        counts = cur.fetchone()
+        cur.execute("SELECT name, bucket, value FROM metrics WHERE bucket > now() - interval '7 days'")
+        return counts, cur.fetchall()
+
+    async def get(self):
+        now = time.monotonic()
+        if self.snapshot is None or now - self.snapshot_at > STATS_TTL:
+            await self.flush()
+            self.snapshot = await db.run(self._load)
+            self.snapshot_at = now
+        return self.snapshot
+
+    def series(self, rows, name, step, count):
+        # Sums the hourly buckets of one metric into count steps ending now.
+        end = utcnow()
+        values = [0] * count
+        for n, bucket, value in rows:
+            i = count - 1 - int((end - bucket) / step)
+            if n == name and 0 <= i < count:
+                values[i] += value
+        return values
+
+metrics = Metrics()
+
+# === FAN-OUT ===
+# Bulk Telegram calls go through one shared limiter: a global token bucket
+# (Telegram allows ~30 msg/s per bot) plus a bucket per chat (~1 msg/s).
+# A 429 pauses the global bucket for the retry_after Telegram asks for.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = self._refill()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class RateLimiter:
+    def __init__(self, rate, chat_rate):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chats = {}
+
+    def _chat(self, chat_id):
+        if len(self.chats) > 10000:
+            self.chats = {c: b for c, b in self.chats.items() if not b.idle()}
+        if chat_id not in self.chats:
+            self.chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        return self.chats[chat_id]
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None:
+            await self._chat(chat_id).acquire()
+        await self.bucket.acquire()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+rate_limiter = RateLimiter(FANOUT_RATE, FANOUT_CHAT_RATE)
+
+# === JOB QUEUE ===
+# Side effects that must survive a restart (messages, channel kicks, invite
+# link revocations) are rows in the jobs table, usually inserted in the same
+# transaction as the change that caused them. Workers on every replica claim
+# due jobs with SKIP LOCKED; claiming pushes run_at out by JOB_LEASE, so jobs
+# held by a crashed worker become due again on their own. Transient failures
+# back off exponentially and end up as dead letters after max_attempts.
+# Jobs that belong to a batch report progress by editing the admin's message.
+def new_batch(cur, label, notify=(None, None)):
+    cur.execute("INSERT INTO job_batches (label, chat_id, message_id) VALUES (%s, %s, %s) RETURNING id", (label, *notify))
+    return cur.fetchone()[0]
+
+def close_batch(cur, batch_id, total):
+    cur.execute("UPDATE job_batches SET total = %s, finished_at = CASE WHEN %s = 0 THEN now() END WHERE id = %s",
+                (total, total, batch_id))
+
+def batch_progress(label, total, done, failed, blocked, started, finished):
+    status = "✅ Done" if finished else "⏳ In progress"
+    elapsed = ((finished or utcnow()) - started).total_seconds()
+    return (f"{label}: {done + failed + blocked}/{total} processed. {status}\n"
+            f"📨 Sent: {done}\n"
+            f"🚫 Blocked: {blocked}\n"
+            f"⚠️ Failed: {failed}\n"
+            f"⏱️ Took {elapsed:.1f}s")
+
+def enqueue(cur, kind, payloads, batch_id=None, run_at=None, max_attempts=JOB_MAX_ATTEMPTS):
+    payloads = list(payloads)
+    if not payloads:
+        return 0
+    cur.execute("""
+        INSERT INTO jobs (kind, payload, batch_id, run_at, max_attempts)
+        SELECT %s, p, %s, COALESCE(%s, now()), %s FROM jsonb_array_elements(%s) p
+    """, (kind, batch_id, run_at, max_attempts, Json(payloads)))
+    return cur.rowcount
+
+def message(chat_id, text, parse_mode=None):
+    return {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+
+async def job_message(p):
+    await rate_limiter.acquire(p["chat_id"])
+    await application.bot.send_message(p["chat_id"], p["text"], parse_mode=p.get("parse_mode"))
+
+async def job_evict(p):
+    await rate_limiter.acquire()
+    await evict_user(p["chat_id"], p["user_id"])
+
+async def job_revoke_link(p):
+    await rate_limiter.acquire()
+    try:
+        await application.bot.revoke_chat_invite_link(p["chat_id"], p["invite_link"])
+    except telegram.error.RetryAfter:
+        raise
+    except telegram.error.TelegramError:
+        # The link has expired by the time its revocation is due, so
+        # retrying buys nothing.
+        pass
+
+JOB_HANDLERS = {
+    "message": job_message,
+    "evict": job_evict,
+    "revoke_link": job_revoke_link,
+}
+
+# Errors that retrying can't fix: the job is dropped and counted as failed.
+JOB_PERMANENT_ERRORS = (telegram.error.Forbidden, telegram.error.BadRequest, telegram.error.ChatMigrated)
+JOB_TRANSIENT_ERRORS = (telegram.error.TimedOut, telegram.error.NetworkError)
+
+class JobQueue:
+    def __init__(self, chunk, concurrency):
+        self.chunk = chunk
+        self.concurrency = concurrency
+        self.wakeup = asyncio.Event()
+        self.metrics = Counter()
+        self.errors = Counter()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def _claim(self, cur):
+        cur.execute("""
+            UPDATE jobs j SET attempts = j.attempts + 1, run_at = now() + %s
+            FROM (SELECT id FROM jobs WHERE NOT dead AND run_at <= now()
+                  ORDER BY run_at, id LIMIT %s FOR UPDATE SKIP LOCKED) due
+            WHERE j.id = due.id
+            RETURNING j.id, j.kind, j.payload, j.batch_id, j.attempts, j.max_attempts
+        """, (timedelta(seconds=JOB_LEASE), self.chunk))
+        return sorted(cur.fetchall())
+
+    async def _attempt(self, job):
+        # Returns (id, batch_id, outcome, retry delay, attempts to refund, error).
+        job_id, kind, payload, batch_id, attempts, max_attempts = job
+        try:
+            await JOB_HANDLERS[kind](payload)
+            return job_id, batch_id, "done", None, 0, None
+        except telegram.error.RetryAfter as e:
+            rate_limiter.pause(e.retry_after)
+            return job_id, batch_id, "retry", e.retry_after, 1, repr(e)
+        except JOB_PERMANENT_ERRORS as e:
+            self.errors[type(e).__name__] += 1
+            # Forbidden: the user blocked the bot (or it lost its admin rights).
+            outcome = "blocked" if isinstance(e, telegram.error.Forbidden) else "failed"
+            return job_id, batch_id, outcome, None, 0, repr(e)
+        except Exception as e:
+            if not isinstance(e, JOB_TRANSIENT_ERRORS):
+                logger.exception("Job %s (%s) failed", job_id, kind)
+            self.errors[type(e).__name__] += 1
+            if attempts >= max_attempts or not isinstance(e, JOB_TRANSIENT_ERRORS):
+                return job_id, batch_id, "dead", None, 0, repr(e)
+            return job_id, batch_id, "retry", min(JOB_BACKOFF * 2 ** (attempts - 1), JOB_BACKOFF_MAX), 0, repr(e)
+
+    async def _execute(self, jobs):
+        pending, results = iter(jobs), []
+
+        async def worker():
+            for job in pending:
+                results.append(await self._attempt(job))
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return results
+
+    @staticmethod
+    def _record(cur, results):
+        cur.execute("DELETE FROM jobs WHERE id = ANY(%s)", ([r[0] for r in results if r[2] in ("done", "failed", "blocked")],))
+        cur.execute("UPDATE jobs SET dead = TRUE, last_error = e FROM unnest(%s::bigint[], %s::text[]) AS d(id, e) "
+                    "WHERE jobs.id = d.id",
+                    ([r[0] for r in results if r[2] == "dead"], [r[5] for r in results if r[2] == "dead"]))
+        retries = [r for r in results if r[2] == "retry"]
+        cur.execute("""
+            UPDATE jobs SET run_at = now() + make_interval(secs => r.delay), attempts = attempts - r.refund, last_error = r.e
+            FROM unnest(%s::bigint[], %s::float8[], %s::int[], %s::text[]) AS r(id, delay, refund, e)
+            WHERE jobs.id = r.id
+        """, ([r[0] for r in retries], [r[3] for r in retries], [r[4] for r in retries], [r[5] for r in retries]))
+        finished = Counter((r[1], "failed" if r[2] == "dead" else r[2]) for r in results if r[1] and r[2] != "retry")
+        batches = []
+        for batch_id in sorted({b for b, _ in finished}):
+            done, failed, blocked = (finished[batch_id, o] for o in ("done", "failed", "blocked"))
+            cur.execute("UPDATE job_batches SET done = done + %s, failed = failed + %s, blocked = blocked + %s, "
+                        "finished_at = CASE WHEN done + failed + blocked + %s >= total THEN now() END "
+                        "WHERE id = %s RETURNING label, chat_id, message_id, total, done, failed, blocked, created_at, finished_at",
+                        (done, failed, blocked, done + failed + blocked, batch_id))
+            batches.append(cur.fetchone())
+        return batches
+
+    async def run(self):
+        while True:
+            try:
+                jobs = await db.run(self._claim)
+                if not jobs:
+                    row = await db.fetchone("SELECT MIN(run_at) FROM jobs WHERE NOT dead")
+                    timeout = (row[0] - utcnow()).total_seconds() if row and row[0] else 60
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), max(0.0, min(timeout, 60)))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                results = await self._execute(jobs)
+                self.metrics.update(r[2] for r in results)
+                for batch in await db.run(self._record, results):
+                    if batch and batch[1] and batch[2]:
+                        label, chat_id, message_id, *progress = batch
+                        try:
+                            await application.bot.edit_message_text(batch_progress(label, *progress), chat_id, message_id)
+                        except telegram.error.TelegramError:
+                            pass
+            except Exception:
+                logger.exception("Job worker failed")
+                await asyncio.sleep(5)
+
+job_queue = JobQueue(JOB_CHUNK, FANOUT_CONCURRENCY)
+
+def message_all_users(cur, batch_id, text):
+    cur.execute("""
+        INSERT INTO jobs (kind, payload, batch_id, max_attempts)
+        SELECT 'message', jsonb_build_object('chat_id', u.bound_user, 'text', %s::text), %s, %s
+        FROM (SELECT DISTINCT bound_user FROM keys WHERE bound_user IS NOT NULL) u
+    """, (text, batch_id, JOB_MAX_ATTEMPTS))
+    return (cur.rowcount,)
+
+async def start_batch(update, label, fill, *args):
+    # fill(cur, batch_id, *args) queues the batch's jobs and returns how many,
+    # plus anything else the caller wants back.
+    msg = await update.message.reply_text(f"{label}: queueing...")
+
+    def create(cur):
+        batch_id = new_batch(cur, label, (msg.chat_id, msg.message_id))
+        total, *extra = fill(cur, batch_id, *args)
+        close_batch(cur, batch_id, total)
+        return (total, *extra)
+
+    result = await db.run(create)
+    job_queue.notify()
+    if not result[0]:
+        now = utcnow()
+        await msg.edit_text(batch_progress(label, 0, 0, 0, 0, now, now))
+    return result
+
+# === INVITE LINK REVOCATION ===
+# Links handed out by /use are revoked by the job queue rather than by
+# sleeping in the handler, so links issued just before a restart are still
+# revoked once the bot is back.
+async def schedule_link_revocations(links, delay=INVITE_REVOKE_AFTER):
+    revoke_at = utcnow() + timedelta(seconds=delay)
+    await db.run(enqueue, "revoke_link", [{"chat_id": ch, "invite_link": link} for ch, link in links], None, revoke_at)
+    job_queue.notify()
+
+# === JOIN REQUESTS ===
+# With JOIN_REQUESTS=1 every channel gets one persistent "request to join"
+# link, created on first use and shared by all replicas through
+# channel_links. /use only hands the link out; each join request is then
+# approved or declined against the requester's entitlements, so redeeming a
+# key costs no link API calls.
+class JoinLinks:
+    channel = "join_links"
+
+    def __init__(self):
+        self.links = {}
+        self.locks = {}
+
+    @staticmethod
+    def _store(cur, ch, link):
+        cur.execute("INSERT INTO channel_links (channel, invite_link) VALUES (%s, %s) ON CONFLICT DO NOTHING", (ch, link))
+        cur.execute("SELECT invite_link FROM channel_links WHERE channel = %s", (ch,))
+        stored = cur.fetchone()[0]
+        if stored != link:
+            # Another replica created one first: ours is never handed out.
+            enqueue(cur, "revoke_link", [{"chat_id": ch, "invite_link": link}])
+        return stored
+
+    async def get(self, bot, ch):
+        if ch in self.links:
+            return self.links[ch]
+        async with self.locks.setdefault(ch, asyncio.Lock()):
+            if ch not in self.links:
+                row = await db.fetchone("SELECT invite_link FROM channel_links WHERE channel = %s", (ch,))
+                if row:
+                    self.links[ch] = row[0]
+                else:
+                    link = await bot.create_chat_invite_link(chat_id=ch, creates_join_request=True, name="Key holders")
+                    self.links[ch] = await db.run(self._store, ch, link.invite_link)
+        return self.links[ch]
+
+    @staticmethod
+    def _drop(cur):
+        cur.execute("DELETE FROM channel_links RETURNING channel, invite_link")
+        rows = cur.fetchall()
+        enqueue(cur, "revoke_link", ({"chat_id": ch, "invite_link": link} for ch, link in rows))
+        return len(rows)
+
+    async def reset(self):
+        dropped = await db.run(self._drop)
+        job_queue.notify()
+        self.links.clear()
+        await pg_listener.publish(self.channel)
+        return dropped
+
+    async def receive(self, data):
+        self.links.clear()
+
+join_links = JoinLinks()
+pg_listener.subscribe(JoinLinks.channel, join_links.receive)
+
+def entitled(rows, chat):
+    names = {str(chat.id)}
+    if chat.username:
+        names.add(f"@{chat.username}".lower())
+    now = utcnow()
+    return any(not revoked and (expiry is None or expiry > now)
+               and any(ch.lower() in names for ch in (channels or "").split("+"))
+               for _, expiry, channels, revoked in rows)
+
+async def join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    req = update.chat_join_request
+    approve = entitled(await entitlements.get(req.from_user.id), req.chat)
+    try:
+        if approve:
+            await req.approve()
+        else:
+            await req.decline()
+    except telegram.error.TelegramError as e:
+        # Usually a request another replica or an admin already handled.
+        logger.warning("Join request of %s in %s: %s", req.from_user.id, req.chat.id, e)
+        return
+    metrics.incr("join_approvals" if approve else "join_declines")
+
+# === CHANNEL EVICTION ===
+# Revoking keys only flips rows in one statement and queues an evict job per
+# (user, channel) membership to remove, in the same transaction. With
+# MEMBER_INDEX=1 only users the membership index has in a channel are
+# evicted from it, once the index for that channel has been seeded (see
+# MEMBERSHIP INDEX); until then the channel is still evicted blindly.
+MEMBER_MATCH = "(c.channel = mc.chat_id::text OR lower(c.channel) = mc.username)"
+MEMBERS_SEEDED = ("EXISTS (SELECT 1 FROM job_batches b WHERE b.id = mc.seed_batch "
+                  "AND b.finished_at IS NOT NULL AND b.failed = 0 AND b.blocked = 0)")
+EVICT_MEMBERS_ONLY = f"""
+    AND (NOT EXISTS (SELECT 1 FROM member_channels mc WHERE {MEMBER_MATCH} AND {MEMBERS_SEEDED})
+         OR EXISTS (SELECT 1 FROM member_channels mc JOIN channel_members m USING (chat_id)
+                    WHERE m.user_id = r.bound_user AND {MEMBER_MATCH}))
+""" if MEMBER_INDEX else ""
+
+def revoke_and_evict(cur, batch_id, where, params=()):
+    cur.execute(f"""
+        WITH revoked AS (
+            UPDATE keys SET revoked = TRUE WHERE {where} RETURNING key, bound_user
+        ), queued AS (
+            INSERT INTO jobs (kind, payload, batch_id, max_attempts)
+            SELECT DISTINCT 'evict', jsonb_build_object('user_id', r.bound_user, 'chat_id', c.channel), %s, %s
+            FROM revoked r JOIN key_channels c ON c.key = r.key
+            WHERE r.bound_user IS NOT NULL {EVICT_MEMBERS_ONLY}
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM queued), (SELECT COUNT(*) FROM revoked),
+               (SELECT array_agg(DISTINCT bound_user) FROM revoked WHERE bound_user IS NOT NULL)""",
+                (*params, batch_id, JOB_MAX_ATTEMPTS))
+    queued, keys, users = cur.fetchone()
+    return queued, keys, users or []
+
+async def evict_user(chat_id, user_id):
+    await application.bot.ban_chat_member(chat_id, user_id)
+    await application.bot.unban_chat_member(chat_id, user_id)
+
+async def start_eviction(update, label, where, params=()):
+    queued, keys, users = await start_batch(update, f"🔐 {label}", revoke_and_evict, where, params)
+    await entitlements.invalidate(users)
+    return keys, queued
+
+# === MEMBERSHIP INDEX ===
+# chat_member updates keep channel_members in step with who is actually in
+# each channel. Every RECONCILE_INTERVAL seconds one replica diffs it
+# against live keys and queues evictions for members without one, which
+# also catches anyone who got in through a leaked link. Telegram only sends
+# chat_member updates when asked for them, so MEMBER_INDEX=1 requests them
+# for the registered webhook (or getUpdates) on startup.
+# Members who joined before that never send an update, so the first update
+# from a channel seeds its index: a check_member job asks get_chat_member
+# about every user bound to a key for it. Evictions only trust the index
+# once that batch has finished without failures.
+# Only chats that keys grant access to are indexed, seeded or reconciled:
+# the bot may well administer chats that have nothing to do with keys.
+RECONCILE_LOCK = 7311002
+KEYED_CHANNEL = f"EXISTS (SELECT 1 FROM key_channels c WHERE {MEMBER_MATCH})"
+RECONCILE_SQL = f"""
+    SELECT m.chat_id, m.user_id FROM channel_members m JOIN member_channels mc USING (chat_id)
+    WHERE m.status IN ('member', 'restricted') AND m.user_id <> %(admin)s AND {KEYED_CHANNEL}
+      AND m.user_id NOT IN (SELECT user_id FROM admins)
+      AND NOT EXISTS (
+          SELECT 1 FROM keys k JOIN key_channels c ON c.key = k.key
+          WHERE k.bound_user = m.user_id AND NOT k.revoked AND (k.expiry IS NULL OR k.expiry > now()) AND {MEMBER_MATCH})
+      AND NOT EXISTS (
+          SELECT 1 FROM jobs j WHERE j.kind = 'evict' AND NOT j.dead AND (j.payload->>'user_id')::bigint = m.user_id)
+"""
+
+def member_status(member):
+    # The status to index, or None for users who aren't in the chat.
+    if member.status in (ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER) or (
+            member.status == ChatMember.RESTRICTED and member.is_member):
+        return member.status
+    return None
+
+def record_member(cur, chat_id, username, user_id, status):
+    cur.execute(f"SELECT {KEYED_CHANNEL} FROM (VALUES (%s::bigint, %s)) mc (chat_id, username)", (chat_id, username))
+    if not cur.fetchone()[0]:
+        return False
+    cur.execute("INSERT INTO member_channels (chat_id, username) VALUES (%s, %s) ON CONFLICT (chat_id) DO UPDATE "
+                "SET username = EXCLUDED.username WHERE member_channels.username IS DISTINCT FROM EXCLUDED.username",
+                (chat_id, username))
+    cur.execute("SELECT seed_batch IS NULL FROM member_channels WHERE chat_id = %s", (chat_id,))
+    unseeded = cur.fetchone()[0]
+    if status:
+        cur.execute("INSERT INTO channel_members (chat_id, user_id, status) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (chat_id, user_id) DO UPDATE SET status = EXCLUDED.status", (chat_id, user_id, status))
+    else:
+        cur.execute("DELETE FROM channel_members WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+    return unseeded
+
+def seed_channels(cur):
+    cur.execute(f"SELECT mc.chat_id, mc.username FROM member_channels mc WHERE mc.seed_batch IS NULL AND {KEYED_CHANNEL} "
+                "FOR UPDATE SKIP LOCKED")
+    channels = cur.fetchall()
+    for chat_id, username in channels:
+        batch_id = new_batch(cur, f"🧭 seed {username or chat_id}")
+        cur.execute(f"""
+            INSERT INTO jobs (kind, payload, batch_id, max_attempts)
+            SELECT DISTINCT 'check_member', jsonb_build_object('chat_id', mc.chat_id, 'user_id', k.bound_user), %s, %s
+            FROM member_channels mc JOIN key_channels c ON {MEMBER_MATCH} JOIN keys k ON k.key = c.key
+            WHERE mc.chat_id = %s AND k.bound_user IS NOT NULL""", (batch_id, JOB_MAX_ATTEMPTS, chat_id))
+        close_batch(cur, batch_id, cur.rowcount)
+        cur.execute("UPDATE member_channels SET seed_batch = %s WHERE chat_id = %s", (batch_id, chat_id))
+    return len(channels)
+
+async def seed_members():
+    if await db.run(seed_channels):
+        job_queue.notify()
+
+async def job_check_member(p):
+    await rate_limiter.acquire()
+    try:
+        status = member_status(await application.bot.get_chat_member(p["chat_id"], p["user_id"]))
+    except telegram.error.BadRequest:
+        # "user not found": they never joined.
+        return
+    # Seeding only adds members: a chat_member update that raced it is newer
+    # than this answer, and a stale "member" only costs an extra eviction.
+    if status:
+        await db.execute("INSERT INTO channel_members (chat_id, user_id, status) VALUES (%s, %s, %s) "
+                         "ON CONFLICT DO NOTHING", (p["chat_id"], p["user_id"], status))
+
+JOB_HANDLERS["check_member"] = job_check_member
+
+async def chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cm = update.chat_member
+    new = cm.new_chat_member
+    username = f"@{cm.chat.username}".lower() if cm.chat.username else None
+    if await db.run(record_member, cm.chat.id, username, new.user.id, member_status(new)):
+        await seed_members()
+
+async def request_member_updates():
+    info = await application.bot.get_webhook_info()
+    if info.url and "chat_member" not in (info.allowed_updates or ()):
+        await application.bot.set_webhook(info.url, allowed_updates=Update.ALL_TYPES)
+
+class MemberReconciler:
+    def __init__(self):
+        self.last = None
+
+    @staticmethod
+    def _reconcile(cur):
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (RECONCILE_LOCK,))
+        if not cur.fetchone()[0]:
+            return None
+        cur.execute(RECONCILE_SQL, {"admin": ADMIN_ID})
+        rows = cur.fetchall()
+        if not rows:
+            return 0
+        batch_id = new_batch(cur, "🧭 reconcile")
+        queued = enqueue(cur, "evict", ({"chat_id": ch, "user_id": uid} for ch, uid in rows), batch_id)
+        close_batch(cur, batch_id, queued)
+        return queued
+
+    async def reconcile(self):
+        # None when another replica is already reconciling.
+        await seed_members()
+        queued = await db.run(self._reconcile)
+        if queued:
+            job_queue.notify()
+            metrics.incr("reconcile_evictions", queued)
+        if queued is not None:
+            self.last = (utcnow(), queued)
+        return queued
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(RECONCILE_INTERVAL)
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception("Membership reconciliation failed")
+
+member_reconciler = MemberReconciler()
+
+# === EXPIRY SCHEDULER ===
+# Keeps every pending expiry and 3-day reminder of live keys in a min-heap
+# and sleeps until the earliest one is due. Heap entries are only hints:
+# the SQL that acts on them re-checks the row, so keys extended, renewed or
+# revoked since they were scheduled are skipped, and reminded_at makes
+# reminders idempotent across restarts and replicas.
+
+class ExpiryScheduler:
+    def __init__(self):
+        self.heap = []
+        self.wakeup = asyncio.Event()
+        self.loaded_at = None
+
+    def schedule(self, key, expiry, reminded=False):
+        if not expiry:
+            return
+        if not reminded:
+            heapq.heappush(self.heap, (expiry - REMIND_BEFORE, "remind", key))
+        heapq.heappush(self.heap, (expiry, "expire", key))
+        self.wakeup.set()
+
+    async def reload(self):
+        rows = await db.fetchall("SELECT key, expiry, reminded_at FROM keys WHERE NOT revoked AND expiry IS NOT NULL")
+        self.heap = []
+        for key, expiry, reminded in rows:
+            if reminded is None:
+                self.heap.append((expiry - REMIND_BEFORE, "remind", key))
+            self.heap.append((expiry, "expire", key))
+        heapq.heapify(self.heap)
+        self.loaded_at = time.monotonic()
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                if self.loaded_at is None or time.monotonic() - self.loaded_at > SCHEDULER_RELOAD:
+                    await self.reload()
+                now = utcnow()
+                due = {"remind": [], "expire": []}
+                while self.heap and self.heap[0][0] <= now:
+                    _, kind, key = heapq.heappop(self.heap)
+                    due[kind].append(key)
+                if due["remind"]:
+                    await self.send_reminders(due["remind"], now)
+                if due["expire"]:
+                    await self.expire(due["expire"], now)
+                timeout = (self.heap[0][0] - now).total_seconds() if self.heap else SCHEDULER_RELOAD
+            except Exception:
+                logger.exception("Expiry scheduler failed")
+                timeout = 5
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0.0, min(timeout, SCHEDULER_RELOAD)))
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def _remind(cur, keys, now):
+        cur.execute(
+            f"UPDATE keys k SET reminded_at = %s WHERE k.key = ANY(%s) AND NOT k.revoked AND k.reminded_at IS NULL "
+            f"AND k.bound_user IS NOT NULL AND k.expiry <= %s AND k.expiry > %s "
+            f"RETURNING k.key, k.bound_user, k.expiry, {KEY_CHANNELS}",
+            (now, keys, now + REMIND_BEFORE, now))
+        return enqueue(cur, "message", reminder_messages(cur.fetchall()))
+
+    async def send_reminders(self, keys, now):
+        if await db.run(self._remind, keys, now):
+            job_queue.notify()
+
+    @staticmethod
+    def _expire(cur, keys, now):
+        batch_id = new_batch(cur, "⌛ auto-expiry")
+        queued, expired, users = revoke_and_evict(cur, batch_id, "key = ANY(%s) AND NOT revoked AND expiry <= %s", (keys, now))
+        close_batch(cur, batch_id, queued)
+        return expired, users
+
+    async def expire(self, keys, now):
+        expired, users = await db.run(self._expire, keys, now)
+        metrics.incr("expiries", expired)
+        job_queue.notify()
+        await entitlements.invalidate(users)
+
+def reminder_messages(rows):
+    for k, uid, dt, ch in rows:
+        yield message(uid, f"🔔 *Access Expiring Soon!*\n"
+                           f"Your key `{k}` will expire on `{dt.strftime('%Y-%m-%d %H:%M')}` UTC.\n"
+                           f"Channels: {ch}\nPlease renew soon to avoid losing access.", "Markdown")
+
+expiry_scheduler = ExpiryScheduler()
+
+# === KEY ARCHIVE ===
+# Revoked and expired keys move, ARCHIVE_BATCH at a time, from keys into
+# key_archive, which is partitioned by the month they were archived in. The
+# hot table then only holds live keys; /keyinfo and /whohas read the archive
+# when asked, and ARCHIVE_RETENTION_MONTHS drops whole months at once.
+# Only revoked keys move: expired keys the scheduler hasn't got to yet are
+# revoked, with their evictions queued, before each pass.
+ARCHIVE_LOCK = 7311003
+ARCHIVE_SQL = """
+    WITH dead AS (
+        SELECT k.key FROM keys k WHERE k.revoked LIMIT %(batch)s FOR UPDATE SKIP LOCKED
+    ), moved AS (
+        DELETE FROM keys k USING dead d WHERE k.key = d.key
+        RETURNING k.key, k.bound_user, k.expiry, k.duration, k.revoked, k.reminded_at
+    ), archived AS (
+        INSERT INTO key_archive (key, channels, bound_user, expiry, duration, revoked, reminded_at, archived_at)
+        SELECT m.key, ARRAY(SELECT c.channel FROM key_channels c WHERE c.key = m.key ORDER BY c.channel),
+               m.bound_user, m.expiry, m.duration, m.revoked, m.reminded_at, %(now)s
+        FROM moved m
+        RETURNING bound_user
+    )
+    SELECT COUNT(*), array_agg(DISTINCT bound_user) FILTER (WHERE bound_user IS NOT NULL) FROM archived
+"""
+ARCHIVE_PARTITIONS_SQL = ("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                          "WHERE i.inhparent = 'key_archive'::regclass ORDER BY c.relname")
+
+def archive_partition(cur, at):
+    start = at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS key_archive_{start:%Y_%m} PARTITION OF key_archive "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+
+class KeyArchiver:
+    @staticmethod
+    def _expire(cur, now):
+        cur.execute("SELECT EXISTS (SELECT 1 FROM keys WHERE NOT revoked AND expiry <= %s)", (now,))
+        if not cur.fetchone()[0]:
+            return 0, []
+        batch_id = new_batch(cur, "⌛ auto-expiry")
+        queued, expired, users = revoke_and_evict(cur, batch_id, "NOT revoked AND expiry <= %s", (now,))
+        close_batch(cur, batch_id, queued)
+        return expired, users
+
+    @staticmethod
+    def _archive(cur, now):
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (ARCHIVE_LOCK,))
+        if not cur.fetchone()[0]:
+            return None
+        archive_partition(cur, now)
+        cur.execute(ARCHIVE_SQL, {"now": now, "batch": ARCHIVE_BATCH})
+        return cur.fetchone()
+
+    async def archive(self):
+        # None when another replica is already archiving.
+        expired, users = await db.run(self._expire, utcnow())
+        if expired:
+            metrics.incr("expiries", expired)
+            job_queue.notify()
+            await entitlements.invalidate(users)
+        total = 0
+        while True:
+            result = await db.run(self._archive, utcnow())
+            if result is None:
+                return total or None
+            moved, users = result
+            total += moved
+            await entitlements.invalidate(users or [])
+            if moved < ARCHIVE_BATCH:
+                break
+        metrics.incr("archived_keys", total)
+        return total
+
+    @staticmethod
+    def _prune(cur, oldest):
+        cur.execute(ARCHIVE_PARTITIONS_SQL)
+        dropped = [name for name, in cur.fetchall() if name < oldest]
+        for name in dropped:
+            cur.execute(f"DROP TABLE {name}")
+        return dropped
+
+    async def prune(self):
+        # Keeps the current month and the ARCHIVE_RETENTION_MONTHS before it.
+        if not ARCHIVE_RETENTION_MONTHS:
+            return []
+        now = utcnow()
+        month = now.year * 12 + now.month - 1 - ARCHIVE_RETENTION_MONTHS
+        return await db.run(self._prune, f"key_archive_{month // 12:04d}_{month % 12 + 1:02d}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.archive()
+                await self.prune()
+            except Exception:
+                logger.exception("Key archiving failed")
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+key_archiver = KeyArchiver()
+
+# === PAGINATION & EXPORTS ===
+def page_rows(rows, cursor, backwards):
+    # rows were fetched with LIMIT PAGE_SIZE + 1 in the direction of travel.
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+        return rows, more, True
+    return rows, cursor is not None, more
+
+def page_markup(tag, arg, rows, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{tag}|<|{rows[0][0]}|{arg}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"{tag}|>|{rows[-1][0]}|{arg}"))
+    # Telegram caps callback data at 64 bytes.
+    buttons = [b for b in buttons if len(b.callback_data.encode()) <= 64]
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def export_csv(cur, query, header):
+    # COPY streams rows straight into a gzip stream that spills to disk past
+    # EXPORT_SPOOL, so exports never hold the table in memory.
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL)
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        gz.write((",".join(header) + "\n").encode())
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV", gz)
+    out.seek(0)
+    return out
+
+async def send_export(update, query, header, filename):
+    # The Bot API upload needs the whole body, but by now it is compressed.
+    with await db.run(export_csv, query, header) as f:
+        await update.message.reply_document(document=f.read(), filename=f"{filename}.csv.gz")
+
+KEYS_HEADER = ['Key', 'Channels', 'User', 'Expiry', 'Revoked']
+
+# === BULK IMPORT ===
+# The way back from the exports: a CSV (gzipped or not) from /backup,
+# /exportkeys, /confirmreset or /genkey is COPYed into a temporary staging
+# table, where invalid rows and in-file duplicates are dropped, and the rest
+# is upserted in the same transaction. Rows that already exist are left
+# alone unless the import runs with "replace".
+# Past IMPORT_BULK_ROWS rows the secondary indexes and foreign keys of the
+# target tables are dropped for the load and rebuilt afterwards, which beats
+# maintaining them row by row, at the cost of locking those tables until
+# the import commits.
+IMPORT_HEADERS = {
+    ("key", "channels", "user", "expiry", "revoked"): ("keys", ("key", "channels", "bound_user", "expiry", "revoked")),
+    ("key", "channels", "bounduser", "expiry", "revoked"): ("keys", ("key", "channels", "bound_user", "expiry", "revoked")),
+    ("key", "channels", "duration"): ("keys", ("key", "channels", "expiry")),
+    ("alias", "channel id"): ("aliases", ("alias", "channel_id")),
+    ("group name", "alias"): ("groups", ("group_name", "alias")),
+}
+
+IMPORT_KINDS = {
+    "keys": {
+        "staging": "key TEXT, channels TEXT, bound_user TEXT, expiry TEXT, revoked TEXT",
+        "tables": ["keys", "key_channels"],
+        "unique": ("key",),
+        "invalid": """CASE
+            WHEN key IS NULL OR btrim(key) = '' THEN 'missing key'
+            WHEN bound_user !~ '^[0-9]{1,18}$' THEN 'bad user id'
+            WHEN expiry !~* '^([0-9]{4}-[0-9]{2}-[0-9]{2}([T ][0-9:.]+)?|[0-9]+d([0-9]+h)?|[0-9]+h|lifetime)$' THEN 'bad expiry'
+            WHEN lower(revoked) NOT IN ('0', '1', 'true', 'false', 't', 'f') THEN 'bad revoked flag'
+        END""",
+        "clear": "DELETE FROM key_channels c USING import_keys i WHERE c.key = i.key",
+        "replace": "UPDATE SET bound_user = EXCLUDED.bound_user, expiry = EXCLUDED.expiry, duration = EXCLUDED.duration, "
+                   "revoked = EXCLUDED.revoked, reminded_at = NULL",
+        "upsert": """
+            WITH upserted AS (
+                INSERT INTO keys (key, bound_user, expiry, duration, revoked)
+                SELECT key, bound_user::bigint,
+                       CASE WHEN expiry ~ '^[0-9]+-' THEN expiry::timestamp AT TIME ZONE 'UTC' END,
+                       CASE WHEN expiry ~ '^[0-9]+[dh]' THEN make_interval(
+                           days => COALESCE(substring(expiry from '^([0-9]+)d')::int, 0),
+                           hours => COALESCE(substring(expiry from '([0-9]+)h')::int, 0)) END,
+                       COALESCE(lower(revoked) IN ('1', 'true', 't'), FALSE)
+                FROM import_keys
+                ON CONFLICT (key) DO {conflict}
+                RETURNING key, xmax = 0 AS inserted
+            ), linked AS (
+                INSERT INTO key_channels (key, channel)
+                SELECT DISTINCT u.key, ch FROM upserted u JOIN import_keys i ON i.key = u.key,
+                       unnest(string_to_array(i.channels, '+')) AS ch
+                WHERE ch <> ''
+                ON CONFLICT DO NOTHING
+            )
+            SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted""",
+    },
+    "aliases": {
+        "staging": "alias TEXT, channel_id TEXT",
+        "tables": ["aliases"],
+        "unique": ("alias",),
+        "invalid": """CASE
+            WHEN alias IS NULL OR btrim(alias) = '' THEN 'missing alias'
+            WHEN channel_id IS NULL OR btrim(channel_id) = '' THEN 'missing channel id'
+        END""",
+        "replace": "UPDATE SET channel_id = EXCLUDED.channel_id",
+        "upsert": """
+            WITH upserted AS (
+                INSERT INTO aliases (alias, channel_id) SELECT alias, channel_id FROM import_aliases
+                ON CONFLICT (alias) DO {conflict}
+                RETURNING xmax = 0 AS inserted
+            )
+            SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted""",
+    },
+    "groups": {
+        "staging": "group_name TEXT, alias TEXT",
+        "tables": ["groups"],
+        "unique": ("group_name", "alias"),
+        "invalid": """CASE
+            WHEN group_name IS NULL OR btrim(group_name) = '' THEN 'missing group'
+            WHEN alias IS NULL OR btrim(alias) = '' THEN 'missing alias'
+        END""",
+        # A group row is nothing but its key, so there is nothing to replace.
+        "replace": "NOTHING",
+        "upsert": """
+            WITH inserted AS (
+                INSERT INTO groups (group_name, alias) SELECT group_name, alias FROM import_groups
+                ON CONFLICT DO {conflict}
+                RETURNING 1
+            )
+            SELECT COUNT(*), 0 FROM inserted""",
+    },
+}
+
+def open_import(f):
+    # Returns the kind, the staged columns and a stream positioned past the header.
+    gzipped = f.read(2) == b"\x1f\x8b"
+    f.seek(0)
+    stream = gzip.GzipFile(fileobj=f, mode="rb") if gzipped else f
+    header = next(csv.reader([stream.readline().decode("utf-8-sig")]), [])
+    header = tuple(c.strip().lower() for c in header)
+    if header not in IMPORT_HEADERS:
+        raise ValueError(f"Unrecognised CSV header: {', '.join(header) or '(empty)'}")
+    return (*IMPORT_HEADERS[header], stream)
+
+def drop_secondary_indexes(cur, tables):
+    # Keeps primary keys and unique constraints, which ON CONFLICT needs.
+    # Returns the statements that put the rest back.
+    cur.execute("""
+        SELECT format('ALTER TABLE %%s DROP CONSTRAINT %%I', conrelid::regclass, conname),
+               format('ALTER TABLE %%s ADD CONSTRAINT %%I %%s', conrelid::regclass, conname, pg_get_constraintdef(oid))
+        FROM pg_constraint WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])
+        UNION ALL
+        SELECT format('DROP INDEX %%I.%%I', schemaname, indexname), indexdef
+        FROM pg_indexes i
+        WHERE schemaname = current_schema() AND tablename = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = to_regclass(format('%%I.%%I', schemaname, indexname)))
+    """, (tables, tables))
+    statements = cur.fetchall()
+    for drop, _ in statements:
+        cur.execute(drop)
+    return [create for _, create in statements]
+
+def import_csv(cur, f, replace=False):
+    kind, columns, stream = open_import(f)
+    spec, table = IMPORT_KINDS[kind], f"import_{kind}"
+    cur.execute(f"CREATE TEMP TABLE {table} (line BIGSERIAL, {spec['staging']}) ON COMMIT DROP")
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH CSV", stream)
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    rows = cur.fetchone()[0]
+    cur.execute(f"DELETE FROM {table} WHERE ({spec['invalid']}) IS NOT NULL RETURNING line, ({spec['invalid']})")
+    invalid = sorted(cur.fetchall())
+    same = " AND ".join(f"a.{c} = b.{c}" for c in spec["unique"])
+    cur.execute(f"DELETE FROM {table} a USING {table} b WHERE {same} AND a.line < b.line")
+    duplicates = cur.rowcount
+    cur.execute(f"ANALYZE {table}")
+    rebuild = drop_secondary_indexes(cur, spec["tables"]) if rows - len(invalid) - duplicates >= IMPORT_BULK_ROWS else []
+    if replace and "clear" in spec:
+        cur.execute(spec["clear"])
+    cur.execute(spec["upsert"].format(conflict=spec["replace"] if replace else "NOTHING"))
+    inserted, updated = cur.fetchone()
+    for statement in rebuild:
+        cur.execute(statement)
+    return {"kind": kind, "rows": rows, "invalid": invalid, "duplicates": duplicates, "inserted": inserted,
+            "updated": updated, "existing": rows - len(invalid) - duplicates - inserted - updated}
+
+def import_report(name, r):
+    lines = [f"📥 {name}: {r['rows']} {r['kind']} rows",
+             f"➕ Inserted: {r['inserted']}",
+             f"♻️ Replaced: {r['updated']}",
+             f"⏭️ Already present: {r['existing']}",
+             f"🔁 Duplicate rows: {r['duplicates']}",
+             f"⚠️ Invalid rows: {len(r['invalid'])}"]
+    # Data rows start on the second line of the file.
+    lines += [f"   line {line + 1}: {reason}" for line, reason in r["invalid"][:10]]
+    return "\n".join(lines)
+
+async def refresh_after_import(kinds):
+    if "keys" in kinds:
+        await entitlements.clear()
+        await key_filter.invalidate()
+    if kinds & {"aliases", "groups"}:
+        await alias_cache.invalidate()
+
+def import_cli(argv):
+    parser = argparse.ArgumentParser(prog="main.py importkeys", description="Load key, alias or group CSV exports.")
+    parser.add_argument("files", nargs="+", help="CSV or CSV.gz files, each imported in its own transaction")
+    parser.add_argument("--replace", action="store_true", help="overwrite rows that already exist")
+    args = parser.parse_args(argv)
+    run_migrations()
+    kinds = set()
+    for path in args.files:
+        with open(path, "rb") as f:
+            start = time.monotonic()
+            r = db.run_sync(import_csv, f, args.replace)
+        kinds.add(r["kind"])
+        print(f"{import_report(os.path.basename(path), r)}\n⏱️ {time.monotonic() - start:.1f}s")
+    # Running replicas pick up new expiries on their next scheduler reload.
+    asyncio.run(refresh_after_import(kinds))
+
+# === /use THROTTLING ===
+# Key guessing is throttled before it costs a query. Failed redemptions are
+# counted per user, and lookups that reach Postgres are counted globally,
+# each over a sliding window: the current fixed window plus the previous one,
+# weighted by how much of it the sliding window still covers. A user past
+# USE_FAIL_LIMIT is told once per window and ignored after that; past
+# USE_GLOBAL_LIMIT everyone is asked to come back shortly.
+# With USE_LIMIT_SHARED=1 replicas add their counts into use_attempts every
+# USE_LIMIT_SYNC seconds and read back the totals that matter: a count below
+# half the limit can't push the sliding window over it.
+class SlidingWindow:
+    def __init__(self, name, limit, window, shared=False, size=100000):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.shared = shared
+        self.size = size
+        self.counts = {}
+        self.unsynced = Counter()
+
+    def _entry(self, scope, bucket):
+        # [bucket, hits in it, hits in the bucket before]
+        entry = self.counts.get(scope)
+        if entry is None or entry[0] < bucket - 1:
+            entry = self.counts[scope] = [bucket, 0, 0]
+        elif entry[0] == bucket - 1:
+            entry[:] = [bucket, 0, entry[1]]
+        return entry
+
+    def estimate(self, scope):
+        bucket, offset = divmod(time.time(), self.window)
+        entry = self._entry(scope, int(bucket))
+        return entry[1] + entry[2] * (1 - offset / self.window)
+
+    def allowed(self, scope):
+        return self.estimate(scope) < self.limit
+
+    def hit(self, scope):
+        bucket = int(time.time() // self.window)
+        self._entry(scope, bucket)[1] += 1
+        if self.shared:
+            self.unsynced[scope, bucket] += 1
+        if len(self.counts) > self.size:
+            self.counts = {s: e for s, e in self.counts.items() if e[0] >= bucket - 1}
+
+    def merge(self, scope, bucket, total):
+        entry = self._entry(scope, int(time.time() // self.window))
+        if bucket == entry[0]:
+            entry[1] = max(entry[1], total)
+        elif bucket == entry[0] - 1:
+            entry[2] = max(entry[2], total)
+
+class UseGuard:
+    def __init__(self, shared):
+        self.failures = SlidingWindow("fail", USE_FAIL_LIMIT, USE_FAIL_WINDOW, shared)
+        self.lookups = SlidingWindow("lookup", USE_GLOBAL_LIMIT, USE_GLOBAL_WINDOW, shared)
+        self.warned = {}
+        self.metrics = Counter()
+
+    def refusal(self, user_id):
+        # None lets the attempt through; otherwise the reply, "" for none at all.
+        if not self.failures.allowed(user_id):
+            self.metrics["user_throttled"] += 1
+            bucket = int(time.time() // self.failures.window)
+            if self.warned.get(user_id, -2) >= bucket - 1:
+                return ""
+            if len(self.warned) > self.failures.size:
+                self.warned = {u: b for u, b in self.warned.items() if b >= bucket - 1}
+            self.warned[user_id] = bucket
+            return "⏳ Too many invalid keys. Try again later."
+        if not self.lookups.allowed("*"):
+            self.metrics["global_throttled"] += 1
+            return "⏳ The bot is busy right now. Try again in a minute."
+        return None
+
+    def suspect(self, user_id):
+        return self.failures.estimate(user_id) >= self.failures.limit / 2
+
+    def lookup(self):
+        self.lookups.hit("*")
+
+    def failed(self, user_id, reason):
+        self.metrics[reason] += 1
+        self.failures.hit(user_id)
+
+    @staticmethod
+    def _sync(cur, rows, since, floors):
+        cur.execute("""
+            INSERT INTO use_attempts (scope, bucket, hits)
+            SELECT * FROM unnest(%s::text[], %s::bigint[], %s::int[])
+            ON CONFLICT (scope, bucket) DO UPDATE SET hits = use_attempts.hits + EXCLUDED.hits
+        """, ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]))
+        cur.execute("SELECT scope, bucket, hits FROM use_attempts "
+                    "WHERE bucket >= %s AND hits >= CASE WHEN scope LIKE 'fail:%%' THEN %s ELSE %s END",
+                    (since, *floors))
+        return cur.fetchall()
+
+    async def sync(self):
+        # Buckets are stored by their start time, so windows of any length share the table.
+        windows = {w.name: w for w in (self.failures, self.lookups)}
+        rows = [(f"{w.name}:{scope}", bucket * w.window, n)
+                for w in windows.values() for (scope, bucket), n in w.unsynced.items()]
+        for w in windows.values():
+            w.unsynced.clear()
+        since = int(time.time()) - 2 * max(w.window for w in windows.values())
+        floors = ((self.failures.limit + 1) // 2, (self.lookups.limit + 1) // 2)
+        for scope, start, total in await db.run(self._sync, rows, since, floors):
+            name, _, key = scope.partition(":")
+            w = windows[name]
+            w.merge(int(key) if key.lstrip("-").isdigit() else key, start // w.window, total)
+
+    async def run(self):
+        pruned = time.monotonic()
+        while True:
+            await asyncio.sleep(USE_LIMIT_SYNC)
+            try:
+                await self.sync()
+                if time.monotonic() - pruned > 60:
+                    await db.execute("DELETE FROM use_attempts WHERE bucket < %s",
+                                     (int(time.time()) - 2 * max(USE_FAIL_WINDOW, USE_GLOBAL_WINDOW),))
+                    pruned = time.monotonic()
+            except Exception:
+                logger.exception("Syncing /use throttling failed")
+
+use_guard = UseGuard(USE_LIMIT_SHARED)
+
 # === USER COMMANDS ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -83,7 +2490,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     "`/contact` — Reach the admin\n\n"
     "🔐 *Admin Panel*\n"
     "`/genkey`, `/revoke`, `/revokeall`, `/extend`, `/extendall`\n"
-    "`/clearkeys`, `/keyinfo`, `/listkeys`, `/exportkeys`\n"
+    "`/clearkeys`, `/keyinfo`, `/listkeys`, `/exportkeys`, `/importkeys`\n"
     "`/setalias`, `/deletealias`, `/listaliases`\n"
     "`/setgroup`, `/listgroups`\n"
     "`/remind3`, `/broadcast`, `/setadmin`",
@@ -92,29 +2499,30 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-    f"📞 *Need help?*\nReach out to the admin directly: [@{ADMIN_CONTACT}](https://t.me/{ADMIN_CONTACT})",
+    f"📞 *Need help?*\nReach out to the admin directly: [@{settings.admin_contact}](https://t.me/{settings.admin_contact})",
     parse_mode="Markdown"
 )
 
 async def mykey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    cur.execute("SELECT key, expiry, channels, revoked FROM keys WHERE bound_user = %s", (user_id,))
-    row = cur.fetchone()
-    if not row:
+    rows = await entitlements.get(user_id)
+    if not rows:
         await update.message.reply_text("🔍 You have no active key.")
         return
-    key, expiry, channels, revoked = row
-    status = "❌ Revoked" if revoked else "✅ Active"
-    expiry_display = expiry or "💎 Lifetime"
-    await update.message.reply_text(
-    f"🧾 *Your Key Summary*\n\n"
-    f"🔑 Key: `{key}`\n"
-    f"📺 Channels: `{channels}`\n"
-    f"📅 Expiry: `{expiry or '💎 Lifetime Access'}`\n"
-    f"📌 Status: `{status}`\n\n"
-    f"✨ Stay premium, stay ahead!",
-    parse_mode="Markdown"
-)
+    out = "🧾 *Your Key Summary*\n\n"
+    for key, expiry, channels, revoked in rows:
+        if revoked:
+            status = "❌ Revoked"
+        elif expiry and expiry < utcnow():
+            status = "⌛ Expired"
+        else:
+            status = "✅ Active"
+        expiry_display = format_expiry(expiry, lifetime="💎 Lifetime Access")
+        out += (f"🔑 Key: `{key}`\n"
+                f"📺 Channels: `{channels}`\n"
+                f"📅 Expiry: `{expiry_display}`\n"
+                f"📌 Status: `{status}`\n\n")
+    await update.message.reply_text(out + "✨ Stay premium, stay ahead!", parse_mode="Markdown")
 
 # === EXTEND / REMIND / BROADCAST ===
 async def extend(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -124,13 +2532,14 @@ async def extend(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     k, dur = context.args
     td = parse_duration(dur)
-    expiry = (datetime.utcnow() + td).isoformat() if td else None
-    cur.execute("UPDATE keys SET expiry = %s WHERE key = %s", (expiry, k))
-    conn.commit()
-    cur.execute("SELECT bound_user FROM keys WHERE key = %s", (k,))
-    row = cur.fetchone()
+    expiry = utcnow() + td if td else None
+    row = await db.fetchone("UPDATE keys SET expiry = %s, duration = NULL, reminded_at = NULL WHERE key = %s RETURNING bound_user", (expiry, k))
+    if row:
+        expiry_scheduler.schedule(k, expiry)
+        await entitlements.invalidate([row[0]])
     if row and row[0]:
-        await context.bot.send_message(row[0], f"⏳ Your key `{k}` has been extended. New expiry: {expiry or '💎 Lifetime'}", parse_mode="Markdown")
+        await db.run(enqueue, "message", [message(row[0], f"⏳ Your key `{k}` has been extended. New expiry: {format_expiry(expiry)}", "Markdown")])
+        job_queue.notify()
     await update.message.reply_text("✅ Key expiry updated.")
 
 async def extendall(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -140,87 +2549,130 @@ async def extendall(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     dur = context.args[0]
     td = parse_duration(dur)
-    expiry = (datetime.utcnow() + td).isoformat() if td else None
-    cur.execute("SELECT key, bound_user FROM keys WHERE revoked = 0")
-    for k, u in cur.fetchall():
-        cur.execute("UPDATE keys SET expiry = %s WHERE key = %s", (expiry, k))
-        if u:
-            try:
-                await context.bot.send_message(u, f"🕓 Your access key `{k}` was extended.\nNew expiry: {expiry or '💎 Lifetime'}", parse_mode="Markdown")
-            except: pass
-    conn.commit()
-    await update.message.reply_text("✅ All keys extended.")
+    expiry = utcnow() + td if td else None
+
+    def extend_all(cur, batch_id):
+        cur.execute("UPDATE keys SET expiry = %s, duration = NULL, reminded_at = NULL WHERE NOT revoked RETURNING key, bound_user", (expiry,))
+        rows = cur.fetchall()
+        notices = (message(u, f"🕓 Your access key `{k}` was extended.\nNew expiry: {format_expiry(expiry)}", "Markdown")
+                   for k, u in rows if u)
+        return enqueue(cur, "message", notices, batch_id), len(rows)
+
+    queued, extended = await start_batch(update, "🕓 extendall", extend_all)
+    await expiry_scheduler.reload()
+    await entitlements.clear()
+    await update.message.reply_text(f"✅ {extended} keys extended. {queued} notifications queued.")
 
 async def remind3(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    now = datetime.utcnow()
-    cur.execute("SELECT key, bound_user, expiry, channels FROM keys WHERE expiry IS NOT NULL AND revoked = 0")
-    count = 0
-    for k, uid, exp, ch in cur.fetchall():
-        dt = datetime.fromisoformat(exp)
-        if 0 <= (dt - now).days <= 3:
-            try:
-                await context.bot.send_message(uid,
-                    f"🔔 *Access Expiring Soon!*\n"
-                    f"Your key `{k}` will expire on `{dt.strftime('%Y-%m-%d %H:%M')}` UTC.\n"
-                    f"Channels: {ch}\nPlease renew soon to avoid losing access.",
-                    parse_mode="Markdown")
-                count += 1
-            except: pass
-    await update.message.reply_text(f"✅ {count} reminders sent.")
+    now = utcnow()
+
+    def remind(cur, batch_id):
+        cur.execute(
+            f"UPDATE keys k SET reminded_at = %s "
+            f"WHERE NOT k.revoked AND k.bound_user IS NOT NULL AND k.expiry >= %s AND k.expiry < %s "
+            f"RETURNING k.key, k.bound_user, k.expiry, {KEY_CHANNELS}",
+            (now, now, now + timedelta(days=4)))
+        return (enqueue(cur, "message", reminder_messages(cur.fetchall()), batch_id),)
+
+    queued, = await start_batch(update, "🔔 remind3", remind)
+    await update.message.reply_text(f"✅ {queued} reminders queued.")
+
+
 # === KEY REDEMPTION ===
+# Binds an unredeemed key in the same statement that reads it. Concurrent
+# redemptions queue on the row lock and only the first one matches
+# bound_user IS NULL; the outer SELECT still sees the row as it was before.
+# Unredeemed keys start their clock now; /addkey keys already have a fixed expiry.
+REDEEM_SQL = f"""
+    WITH claim AS (
+        UPDATE keys SET bound_user = %(user)s, expiry = COALESCE(expiry, now() + duration)
+        WHERE key = %(key)s AND bound_user IS NULL AND NOT revoked
+        RETURNING expiry
+    )
+    SELECT {KEY_CHANNELS}, k.bound_user, k.expiry, k.revoked,
+           EXISTS (SELECT 1 FROM claim), (SELECT expiry FROM claim)
+    FROM keys k WHERE k.key = %(key)s
+"""
+
 async def use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if LOCKED and user_id not in ADMINS:
-    await update.message.reply_text("🔒 The bot is currently under maintenance. Try again later.")
-    return
+    if settings.locked and user_id not in settings.admins:
+        await update.message.reply_text("🔒 The bot is currently under maintenance. Try again later.")
+        return
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /use <KEY>")
         return
     k = context.args[0]
-    cur.execute("SELECT channels, bound_user, expiry, revoked FROM keys WHERE key = %s", (k,))
-    row = cur.fetchone()
-    if not row:
-        await update.message.reply_text(f"❌ Invalid key. Contact @{ADMIN_CONTACT}")
-        return
-    channels, bound_user, expiry, revoked = row
+    held = entitlements.peek(user_id, k)
+    if held:
+        _, expiry_dt, channels, revoked = held
+    else:
+        refusal = None if user_id in settings.admins else use_guard.refusal(user_id)
+        if refusal is not None:
+            if refusal:
+                await update.message.reply_text(refusal)
+            return
+        if not key_filter.might_exist(k) and (PG_NOTIFY or use_guard.suspect(user_id)):
+            use_guard.failed(user_id, "unknown_key")
+            await update.message.reply_text(f"❌ Invalid key. Contact @{settings.admin_contact}")
+            return
+        use_guard.lookup()
+        row = await db.fetchone(REDEEM_SQL, {"key": k, "user": user_id})
+        if not row:
+            use_guard.failed(user_id, "invalid_key")
+            await update.message.reply_text(f"❌ Invalid key. Contact @{settings.admin_contact}")
+            return
+        channels, bound_user, expiry_dt, revoked, claimed, claimed_expiry = row
+        if not claimed and not revoked and bound_user is None:
+            # Lost a race for the key: see who got it.
+            bound_user = (await db.fetchone("SELECT bound_user FROM keys WHERE key = %s", (k,)))[0]
+        if claimed:
+            expiry_dt = claimed_expiry
+            expiry_scheduler.schedule(k, expiry_dt)
+            metrics.incr("redemptions")
+            await entitlements.invalidate([user_id])
+        elif not revoked and bound_user != user_id:
+            use_guard.failed(user_id, "bound_key")
+            await update.message.reply_text(f"🔒 Key already bound to another user. Contact @{settings.admin_contact}")
+            return
     if revoked:
-        await update.message.reply_text(f"🚫 This key has been revoked. Contact @{ADMIN_CONTACT}")
-        return
-    if bound_user and bound_user != user_id:
-        await update.message.reply_text(f"🔒 Key already bound to another user. Contact @{ADMIN_CONTACT}")
+        await update.message.reply_text(f"🚫 This key has been revoked. Contact @{settings.admin_contact}")
         return
 
-    if not bound_user:
-        expiry_dt = datetime.utcnow() + parse_duration(expiry) if expiry else None
-        cur.execute("UPDATE keys SET bound_user = %s, expiry = %s WHERE key = %s",
-                    (user_id, expiry_dt.isoformat() if expiry_dt else None, k))
-        conn.commit()
-    else:
-        expiry_dt = datetime.fromisoformat(expiry) if expiry else None
-
-    if expiry_dt and datetime.utcnow() > expiry_dt:
-    for ch in channels.split("+"):
-        try:
-            await context.bot.ban_chat_member(ch, user_id)
-            await context.bot.unban_chat_member(ch, user_id)
-        except: pass
-    await update.message.reply_text("⏳ Your key has expired. Access removed from all channels. Please contact admin.")
-    return
+    ch_list = channels.split("+") if channels else []
 
+    if expiry_dt and utcnow() > expiry_dt:
+        # Expire it now rather than wait for the scheduler: the evictions go
+        # through the job queue like every other revocation.
+        await expiry_scheduler.expire([k], utcnow())
+        await update.message.reply_text("⏳ Your key has expired. Access removed from all channels. Please contact admin.")
+        return
 
-    ch_list = channels.split("+")
-    for ch in ch_list:
-        try:
-            link = await context.bot.create_chat_invite_link(chat_id=ch, expire_date=datetime.utcnow() + timedelta(seconds=15), member_limit=1)
-            await update.message.reply_text(f"👉 [Join Channel]({link.invite_link})", parse_mode="Markdown")
-            await asyncio.sleep(10)
-            await context.bot.revoke_chat_invite_link(chat_id=ch, invite_link=link.invite_link)
-        except:
-            await update.message.reply_text(f"⚠️ Failed to generate invite for {ch}")
-
-    if not expiry:
-        await update.message.reply_text(
+    if JOIN_REQUESTS:
+        results = await asyncio.gather(*(join_links.get(context.bot, ch) for ch in ch_list), return_exceptions=True)
+    else:
+        link_expiry = utcnow() + timedelta(seconds=INVITE_LINK_TTL)
+        results = await asyncio.gather(
+            *(context.bot.create_chat_invite_link(chat_id=ch, expire_date=link_expiry, member_limit=1) for ch in ch_list),
+            return_exceptions=True)
+    lines, links = [], []
+    for ch, link in zip(ch_list, results):
+        if isinstance(link, Exception):
+            metrics.incr("invite_failures")
+            lines.append(f"⚠️ Failed to generate invite for {escape_markdown(ch)}")
+        elif JOIN_REQUESTS:
+            lines.append(f"👉 [Request to Join]({link})")
+        else:
+            lines.append(f"👉 [Join Channel]({link.invite_link})")
+            links.append((ch, link.invite_link))
+    if links:
+        await schedule_link_revocations(links)
+    if JOIN_REQUESTS and not all(isinstance(r, Exception) for r in results):
+        lines.append("_Tap a link and send the join request: it is approved automatically._")
+
+    if not expiry_dt:
+        footer = (
              "```\n"
     "╔══════════════════════════════════════╗\n"
     "║   🎉 LIFETIME ACCESS UNLOCKED! 🎉    ║\n"
@@ -232,11 +2684,11 @@ async def use(update: Update, context: ContextTypes.DEFAULT_TYPE):
     "║ 🏆 Welcome to the Elite Circle.      ║\n"
     "║ ✨ You’re officially one of us. ✨   ║\n"
     "╚══════════════════════════════════════╝\n"
-    "```",
-            parse_mode="Markdown")
+    "```")
     else:
-        days_left = (expiry_dt - datetime.utcnow()).days
-        await update.message.reply_text(f"✅ Access granted! Your key is valid for *{days_left}* more day(s).", parse_mode="Markdown")
+        days_left = (expiry_dt - utcnow()).days
+        footer = f"✅ Access granted! Your key is valid for *{days_left}* more day(s)."
+    await update.message.reply_text("\n".join(lines) + "\n\n" + footer, parse_mode="Markdown")
 
 # === ADMIN COMMANDS ===
 async def genkey(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -247,31 +2699,33 @@ async def genkey(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     input_value, duration = context.args[0], context.args[1]
     count = int(context.args[2]) if len(context.args) == 3 else 1
+    if not 1 <= count <= GENKEY_MAX:
+        await update.message.reply_text(f"❌ Count must be between 1 and {GENKEY_MAX}.")
+        return
+
+    td = parse_duration(duration)
 
-    group_rows = cur.execute("SELECT alias FROM groups WHERE group_name = %s", (input_value,)); aliases = [r[0] for r in group_rows.fetchall()] if group_rows else input_value.split("+")
-    channels = []
-    for a in aliases:
-        cur.execute("SELECT channel_id FROM aliases WHERE alias = %s", (a,))
-        row = cur.fetchone()
-        channels.append(row[0] if row else a)
-
-    keys_created = []
-    expiry = None if duration.lower() in ("l", "lifetime") else duration
-    for _ in range(count):
-        key = gen_random_key()
-        cur.execute("INSERT INTO keys VALUES (%s, %s, %s, %s, %s)",
-                    (key, "+".join(channels), None, expiry, 0))
-        keys_created.append(key)
-    conn.commit()
-    await update.message.reply_text("✅ Generated keys:\n" + "\n".join(keys_created))
+    channels = await alias_cache.resolve(input_value)
+    keys_created = await db.run(insert_random_keys, count, channels, td)
+    await key_filter.added(keys_created)
+    if count <= GENKEY_INLINE:
+        await update.message.reply_text("✅ Generated keys:\n" + "\n".join(keys_created))
+        return
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Key', 'Channels', 'Duration'])
+    ch, dur = "+".join(channels), format_duration(td) if td else "Lifetime"
+    writer.writerows((k, ch, dur) for k in keys_created)
+    await update.message.reply_document(document=output.getvalue().encode(), filename=f"keys_{input_value}_{count}.csv",
+                                        caption=f"✅ Generated {count} keys.")
 
 async def setalias(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     if len(context.args) != 2:
         await update.message.reply_text("Usage: /setalias <alias> <channel_id>")
         return
-    cur.execute("INSERT INTO aliases VALUES (%s, %s) ON CONFLICT(alias) DO UPDATE SET channel_id = EXCLUDED.channel_id", (context.args[0], context.args[1]))
-    conn.commit()
+    await db.execute("INSERT INTO aliases VALUES (%s, %s) ON CONFLICT(alias) DO UPDATE SET channel_id = EXCLUDED.channel_id", (context.args[0], context.args[1]))
+    await alias_cache.invalidate()
     await update.message.reply_text(f"✅ Alias `{context.args[0]}` → `{context.args[1]}`", parse_mode="Markdown")
 
 async def deletealias(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -279,15 +2733,14 @@ async def deletealias(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /deletealias <alias>")
         return
-    cur.execute("DELETE FROM aliases WHERE alias = %s", (context.args[0],))
-    conn.commit()
+    await db.execute("DELETE FROM aliases WHERE alias = %s", (context.args[0],))
+    await alias_cache.invalidate()
     await update.message.reply_text("🗑️ Alias deleted.")
 
 async def listaliases(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    cur.execute("SELECT * FROM aliases")
-    aliases = cur.fetchall()
-    out = "\n".join([f"{a} → {c}" for a, c in aliases])
+    await alias_cache.ensure()
+    out = "\n".join([f"{a} → {c}" for a, c in alias_cache.aliases.items()])
     await update.message.reply_text(f"📌 Aliases:\n{out}")
 
 async def setgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -296,18 +2749,23 @@ async def setgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /setgroup <group> <alias1> <alias2>")
         return
     group = context.args[0]
-    cur.execute("DELETE FROM groups WHERE group_name = %s", (group,))
-    for a in context.args[1:]:
-        cur.execute("INSERT INTO groups VALUES (%s, %s)", (group, a))
-    conn.commit()
+
+    def replace_group(cur):
+        cur.execute("DELETE FROM groups WHERE group_name = %s", (group,))
+        for a in context.args[1:]:
+            cur.execute("INSERT INTO groups VALUES (%s, %s) ON CONFLICT DO NOTHING", (group, a))
+
+    await db.run(replace_group)
+    await alias_cache.invalidate()
     await update.message.reply_text(f"✅ Group `{group}` updated.", parse_mode="Markdown")
 
 async def listgroups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    cur.execute("SELECT group_name, alias FROM groups")
+    await alias_cache.ensure()
     out = ""
-    for g, a in cur.fetchall():
-        out += f"{g} → {a}\n"
+    for g, aliases in alias_cache.groups.items():
+        for a in aliases:
+            out += f"{g} → {a}\n"
     await update.message.reply_text(f"📂 Groups:\n{out}")
 
 async def revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -316,36 +2774,17 @@ async def revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /revoke <KEY>")
         return
     k = context.args[0]
-    cur.execute("SELECT bound_user, channels FROM keys WHERE key = %s", (k,))
-    row = cur.fetchone()
-    if not row:
+    if not await db.fetchone("SELECT 1 FROM keys WHERE key = %s", (k,)):
         await update.message.reply_text("❌ Key not found.")
         return
-    bound_user, channels = row
-    cur.execute("UPDATE keys SET revoked = 1 WHERE key = %s", (k,))
-    conn.commit()
-    if bound_user:
-        for ch in channels.split("+"):
-            try:
-                await context.bot.ban_chat_member(ch, bound_user)
-                await context.bot.unban_chat_member(ch, bound_user)
-            except: pass
-    await update.message.reply_text("🔒 Key revoked and user removed from channels.")
+    await start_eviction(update, f"revoke {k}", "key = %s", (k,))
+    await update.message.reply_text("🔒 Key revoked. User removal from channels is queued.")
 
 
 async def revokeall(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    cur.execute("SELECT key, bound_user, channels FROM keys WHERE revoked = 0")
-    for k, bound_user, channels in cur.fetchall():
-        cur.execute("UPDATE keys SET revoked = 1 WHERE key = %s", (k,))
-        if bound_user:
-            for ch in channels.split("+"):
-                try:
-                    await context.bot.ban_chat_member(ch, bound_user)
-                    await context.bot.unban_chat_member(ch, bound_user)
-                except: pass
-    conn.commit()
-    await update.message.reply_text("🔐 All keys revoked and users removed from channels.")
+    keys, queued = await start_eviction(update, "revokeall", "NOT revoked")
+    await update.message.reply_text(f"🔐 {keys} keys revoked. {queued} channel removals queued.")
 
 
 async def keyinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -354,82 +2793,111 @@ async def keyinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /keyinfo <KEY>")
         return
     k = context.args[0]
-    cur.execute("SELECT * FROM keys WHERE key = %s", (k,))
-    row = cur.fetchone()
+    row = await db.fetchone(f"SELECT k.key, {KEY_CHANNELS}, k.bound_user, k.expiry, k.duration, k.revoked, k.reminded_at, "
+                            f"NULL FROM keys k WHERE k.key = %s", (k,))
+    if not row:
+        row = await db.fetchone("SELECT key, array_to_string(channels, '+'), bound_user, expiry, duration, revoked, reminded_at, "
+                                "archived_at FROM key_archive WHERE key = %s ORDER BY archived_at DESC LIMIT 1", (k,))
     if not row:
         await update.message.reply_text("❌ Not found.")
         return
-    await update.message.reply_text(f"🔑 Key Info:\n{row}")
+    key, channels, uid, expiry, duration, revoked, reminded_at, archived_at = row
+    await update.message.reply_text(
+        f"🔑 Key Info:\n"
+        f"Key: {key}\n"
+        f"Channels: {channels or '-'}\n"
+        f"User: {uid or '-'}\n"
+        f"Expiry: {format_expiry(expiry, duration)}\n"
+        f"Revoked: {'yes' if revoked else 'no'}\n"
+        f"Reminded: {format_time(reminded_at) if reminded_at else 'no'}"
+        + (f"\n🗄️ Archived: {format_time(archived_at)}" if archived_at else ""))
 
 async def clearkeys(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    now = datetime.utcnow().isoformat()
-    cur.execute("DELETE FROM keys WHERE revoked = 1 OR (expiry IS NOT NULL AND expiry < %s)", (now,))
-    conn.commit()
-    await update.message.reply_text("🧹 Cleared expired/revoked keys.")
+    archived = await key_archiver.archive()
+    if archived is None:
+        await update.message.reply_text("⏳ Keys are already being archived. Try again shortly.")
+        return
+    await update.message.reply_text(f"🧹 Moved {archived} expired/revoked keys to the archive.")
+
+LISTKEYS_FILTERS = {
+    "all": "TRUE",
+    "active": "NOT k.revoked",
+    "revoked": "k.revoked",
+    "bound": "k.bound_user IS NOT NULL",
+    "expiring": "NOT k.revoked AND k.expiry <= %(soon)s",
+}
+
+LISTKEYS_SQL = """
+    SELECT k.key, k.bound_user, k.expiry, k.duration, k.revoked,
+           (SELECT COUNT(*) FROM keys k WHERE {filter})
+    FROM keys k
+    WHERE {filter} AND {where}
+    ORDER BY k.key {order} LIMIT %(limit)s
+"""
+
+async def listkeys_page(name, cursor=None, backwards=False):
+    where = "TRUE" if cursor is None else ("k.key < %(cursor)s" if backwards else "k.key > %(cursor)s")
+    sql = LISTKEYS_SQL.format(filter=LISTKEYS_FILTERS[name], where=where, order="DESC" if backwards else "ASC")
+    rows = await db.fetchall(sql, {"soon": utcnow() + REMIND_BEFORE, "cursor": cursor, "limit": PAGE_SIZE + 1})
+    rows, has_prev, has_next = page_rows(rows, cursor, backwards)
+    if not rows:
+        return "No keys found.", None
+    out = f"🔑 {name.title()} keys: {rows[0][5]}\n"
+    for k, uid, exp, dur, r, _ in rows:
+        status = "❌ Revoked" if r else "✅ Active"
+        out += f"{k} → {uid} | {format_expiry(exp, dur, 'Lifetime')} | {status}\n"
+    return out, page_markup("lk", name, rows, has_prev, has_next)
 
 async def listkeys(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    cur.execute("SELECT key, bound_user, expiry, revoked FROM keys")
-    out = "🔑 All Keys:\n"
-    for k, uid, exp, r in cur.fetchall():
-        status = "❌ Revoked" if r else "✅ Active"
-        out += f"{k} → {uid} | {exp or 'Lifetime'} | {status}\n"
-    await update.message.reply_text(out)
+    name = context.args[0].lower() if context.args else "all"
+    if name not in LISTKEYS_FILTERS:
+        await update.message.reply_text(f"Usage: /listkeys [{'|'.join(LISTKEYS_FILTERS)}]")
+        return
+    out, markup = await listkeys_page(name)
+    await update.message.reply_text(out, reply_markup=markup)
+
+async def listkeys_nav(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        await query.answer()
+        return
+    _, direction, cursor, name = query.data.split("|", 3)
+    out, markup = await listkeys_page(name, cursor, backwards=direction == "<")
+    await query.answer()
+    await query.edit_message_text(out, reply_markup=markup)
 
 async def exportkeys(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    cur.execute("SELECT * FROM keys")
-    data = cur.fetchall()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Key', 'Channels', 'User', 'Expiry', 'Revoked'])
-    writer.writerows(data)
-    output.seek(0)
-    await update.message.reply_document(document=output.getvalue(), filename="keys.csv")
+    await send_export(update, EXPORT_KEYS, KEYS_HEADER, "keys")
 
 async def setadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ADMIN_CONTACT
     if update.effective_user.id != ADMIN_ID: return
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /setadmin <username>")
         return
-    ADMIN_CONTACT = context.args[0]
+    await settings.set("admin_contact", context.args[0])
     await update.message.reply_text("✅ Admin contact updated.")
 
 async def purgeexpired(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
-    now = datetime.utcnow()
-    cur.execute("SELECT key, bound_user, channels, expiry FROM keys WHERE expiry IS NOT NULL AND revoked = 0")
-    expired = 0
-
-    for k, user_id, ch_str, expiry in cur.fetchall():
-        expiry_dt = datetime.fromisoformat(expiry)
-        if now > expiry_dt:
-            if user_id:
-                for ch in ch_str.split("+"):
-                    try:
-                        await context.bot.ban_chat_member(ch, user_id)
-                        await context.bot.unban_chat_member(ch, user_id)
-                    except:
-                        pass
-            cur.execute("UPDATE keys SET revoked = 1 WHERE key = %s", (k,))
-            expired += 1
-
-    conn.commit()
-    await update.message.reply_text(f"🧹 {expired} expired keys processed.\n👤 Bound users removed from channels.")
+    expired, queued = await start_eviction(update, "purgeexpired", "NOT revoked AND expiry < %s", (utcnow(),))
+    await update.message.reply_text(f"🧹 {expired} expired keys processed.\n👤 {queued} channel removals queued.")
 
 # === ADMIN EXTENSIONS ===
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    cur.execute("SELECT COUNT(*) FROM keys"); total_keys = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM keys WHERE revoked = 0"); active_keys = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM keys WHERE revoked = 1"); revoked_keys = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(DISTINCT bound_user) FROM keys WHERE bound_user IS NOT NULL"); users = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM aliases"); alias_count = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(DISTINCT group_name) FROM groups"); group_count = cur.fetchone()[0]
+
+    counts, rows = await metrics.get()
+    total_keys, active_keys, revoked_keys, users, active_users, alias_count, group_count = counts
+    redemptions = metrics.series(rows, "redemptions", timedelta(hours=1), 24)
+    expiries = metrics.series(rows, "expiries", timedelta(days=1), 7)
+    failures = metrics.series(rows, "invite_failures", timedelta(hours=1), 24)
+    approvals = sum(metrics.series(rows, "join_approvals", timedelta(hours=1), 24))
+    declines = sum(metrics.series(rows, "join_declines", timedelta(hours=1), 24))
 
     await update.message.reply_text(
         f"📊 *Bot Stats*\n\n"
@@ -437,25 +2905,197 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ Active Keys: {active_keys}\n"
         f"❌ Revoked Keys: {revoked_keys}\n"
         f"👥 Unique Users: {users}\n"
+        f"🟢 Active Users: {active_users}\n"
         f"🏷️ Aliases: {alias_count}\n"
-        f"🗂️ Groups: {group_count}",
+        f"🗂️ Groups: {group_count}\n\n"
+        f"📈 Redemptions/hour (24h): {sparkline(redemptions)} {sum(redemptions)}\n"
+        f"⌛ Expiries/day (7d): {sparkline(expiries)} {sum(expiries)}\n"
+        f"⚠️ Invite failures/hour (24h): {sparkline(failures)} {sum(failures)}\n"
+        f"🚪 Join requests (24h): {approvals} approved, {declines} declined",
         parse_mode="Markdown")
 
-async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def poolstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    buffer = io.BytesIO()
-    zip_writer = csv.writer(buffer)
+    s = db.stats()
+    await update.message.reply_text(
+        f"🗄️ *DB Pool*\n\n"
+        f"🔌 Connections: {s['size']}/{s['max']}\n"
+        f"⚙️ In use: {s['in_use']}\n"
+        f"⏳ Waiting: {s['waiting']}\n"
+        f"📥 Checkouts: {s['checkouts']} (avg wait {s['avg_wait_ms']:.1f} ms)\n"
+        f"🔎 Queries: {s['queries']}\n"
+        f"⚠️ Errors: {s['errors']}\n"
+        f"🔁 Reconnects: {s['reconnects']}",
+        parse_mode="Markdown")
 
-    cur.execute("SELECT * FROM keys")
-    keys_data = cur.fetchall()
+async def queuestats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    s = update_queue.stats()
+    await update.message.reply_text(
+        f"📬 *Update Queue*\n\n"
+        f"📦 Depth: {s['depth']}/{s['max']}\n"
+        f"👷 Workers: {s['workers']}\n"
+        f"📥 Received: {s['received']}\n"
+        f"✅ Processed: {s['processed']}\n"
+        f"🚫 Dropped: {s['dropped']}\n"
+        f"♻️ Duplicates: {s['duplicates']}\n"
+        f"💬 Busy chats: {s['busy_chats']}\n"
+        f"⚠️ Errors: {s['errors']}\n"
+        f"⏱️ Latency: p50 {s['p50_ms']:.0f} ms · p99 {s['p99_ms']:.0f} ms",
+        parse_mode="Markdown")
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Key', 'Channels', 'User', 'Expiry', 'Revoked'])
-    writer.writerows(keys_data)
-    output.seek(0)
+async def evictions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    rows = await db.fetchall("SELECT label, total, done, failed, blocked, created_at, finished_at FROM job_batches "
+                             "WHERE finished_at IS NULL OR finished_at > now() - interval '1 day' ORDER BY id DESC LIMIT 10")
+    if not rows:
+        await update.message.reply_text("📭 No recent evictions.")
+        return
+    await update.message.reply_text("\n\n".join(batch_progress(*r) for r in rows))
 
-    await update.message.reply_document(document=output.getvalue(), filename="keys_backup.csv")
+async def joinlinks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    if context.args == ["reset"]:
+        dropped = await join_links.reset()
+        await update.message.reply_text(f"♻️ Revoking {dropped} join link(s); new ones are created on the next /use.")
+        return
+    rows = await db.fetchall("SELECT channel, invite_link, created_at FROM channel_links ORDER BY channel")
+    mode = "on" if JOIN_REQUESTS else "off"
+    if not rows:
+        await update.message.reply_text(f"📭 No join links yet (join requests {mode}).")
+        return
+    await update.message.reply_text(f"🔗 Join links (join requests {mode}):\n" + "\n".join(
+        f"{ch}: {link} ({created:%Y-%m-%d})" for ch, link, created in rows), disable_web_page_preview=True)
+
+async def members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    if context.args == ["reconcile"]:
+        queued = await member_reconciler.reconcile()
+        if queued is None:
+            await update.message.reply_text("⏳ A reconciliation is already running.")
+        else:
+            await update.message.reply_text(f"🧭 {queued} non-entitled member(s) queued for removal.")
+        return
+    if context.args == ["reseed"]:
+        # Channels whose seeding had failures start over.
+        n = await db.execute(f"UPDATE member_channels mc SET seed_batch = NULL FROM job_batches b "
+                             f"WHERE b.id = mc.seed_batch AND b.finished_at IS NOT NULL AND NOT {MEMBERS_SEEDED}")
+        await seed_members()
+        await update.message.reply_text(f"🧭 Reseeding {n} channel(s).")
+        return
+    rows = await db.fetchall(f"SELECT mc.chat_id, mc.username, {MEMBERS_SEEDED}, "
+                             f"(SELECT COUNT(*) FROM channel_members m WHERE m.chat_id = mc.chat_id) "
+                             f"FROM member_channels mc ORDER BY mc.chat_id")
+    if not rows:
+        await update.message.reply_text(f"📭 No channel members indexed (member index {'on' if MEMBER_INDEX else 'off'}).")
+        return
+    out = "👥 Indexed members:\n" + "\n".join(
+        f"{username or chat_id}: {n}{'' if seeded else ' (⏳ not seeded yet: evicted blindly)'}"
+        for chat_id, username, seeded, n in rows)
+    if member_reconciler.last:
+        at, queued = member_reconciler.last
+        out += f"\n\n🧭 Last reconcile {at:%Y-%m-%d %H:%M} UTC: {queued} removal(s) queued."
+    await update.message.reply_text(out)
+
+async def archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    if context.args == ["run"]:
+        archived = await key_archiver.archive()
+        dropped = await key_archiver.prune()
+        if archived is None:
+            await update.message.reply_text("⏳ Keys are already being archived.")
+            return
+        await update.message.reply_text(f"🗄️ Archived {archived} key(s), dropped {len(dropped)} old month(s).")
+        return
+    rows = await db.fetchall("SELECT to_char(archived_at AT TIME ZONE 'UTC', 'YYYY-MM'), COUNT(*) FROM key_archive "
+                             "GROUP BY 1 ORDER BY 1")
+    if not rows:
+        await update.message.reply_text(f"📭 The archive is empty (auto-archiving {'on' if KEY_ARCHIVE else 'off'}).")
+        return
+    await update.message.reply_text("🗄️ Archived keys by month:\n" + "\n".join(f"{month}: {n}" for month, n in rows))
+
+JOBS_SQL = """
+    SELECT kind,
+           COUNT(*) FILTER (WHERE NOT dead AND run_at <= now()),
+           COUNT(*) FILTER (WHERE NOT dead AND run_at > now()),
+           COUNT(*) FILTER (WHERE dead),
+           MIN(created_at) FILTER (WHERE NOT dead)
+    FROM jobs GROUP BY kind ORDER BY kind
+"""
+
+def requeue_dead(cur):
+    # Requeued jobs were counted as failed in their batch; they count again
+    # once they finish.
+    cur.execute("""
+        WITH requeued AS (
+            UPDATE jobs SET dead = FALSE, attempts = 0, run_at = now() WHERE dead RETURNING batch_id
+        ), reopened AS (
+            UPDATE job_batches b SET failed = b.failed - r.n, finished_at = NULL
+            FROM (SELECT batch_id, COUNT(*) AS n FROM requeued WHERE batch_id IS NOT NULL GROUP BY batch_id) r
+            WHERE b.id = r.batch_id
+        )
+        SELECT COUNT(*) FROM requeued""")
+    return cur.fetchone()[0]
+
+async def jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    action = context.args[0].lower() if context.args else None
+    if action == "retry":
+        n = await db.run(requeue_dead)
+        job_queue.notify()
+        await update.message.reply_text(f"🔁 {n} dead jobs requeued.")
+        return
+    if action == "purge":
+        n = await db.execute("DELETE FROM jobs WHERE dead")
+        await update.message.reply_text(f"🗑️ {n} dead jobs deleted.")
+        return
+    rows = await db.fetchall(JOBS_SQL)
+    dead = await db.fetchall("SELECT id, kind, attempts, last_error FROM jobs WHERE dead ORDER BY id DESC LIMIT 5")
+    lines = ["🧰 Job queue"]
+    for kind, due, scheduled, failed, oldest in rows:
+        age = f", oldest {format_time(oldest)}" if oldest else ""
+        lines.append(f"• {kind}: {due} due, {scheduled} scheduled, {failed} dead{age}")
+    if not rows:
+        lines.append("• empty")
+    if job_queue.metrics:
+        lines.append("\nThis replica: " + ", ".join(f"{o} {n}" for o, n in sorted(job_queue.metrics.items())))
+    if job_queue.errors:
+        lines.append("Errors: " + ", ".join(f"{e} ×{n}" for e, n in job_queue.errors.most_common()))
+    if dead:
+        lines.append("\nLatest dead letters:")
+        lines += [f"#{i} {kind} after {attempts} attempts: {(error or '')[:120]}" for i, kind, attempts, error in dead]
+        lines.append("/jobs retry to requeue them, /jobs purge to delete them.")
+    await update.message.reply_text("\n".join(lines))
+
+async def importkeys(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Send a CSV with /importkeys as its caption, or reply to one with it.
+    if update.effective_user.id != ADMIN_ID: return
+    msg = update.message
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if not doc:
+        await msg.reply_text("Usage: send a backup CSV with the caption /importkeys [replace], or reply to one with it.")
+        return
+    if doc.file_size and doc.file_size > 20 * 1024 * 1024:
+        await msg.reply_text("❌ Bots can only download files up to 20 MB. Use `python main.py importkeys <file>` instead.",
+                             parse_mode="Markdown")
+        return
+    replace = "replace" in (msg.caption or msg.text or "").lower().split()[1:]
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL) as f:
+        await (await doc.get_file()).download_to_memory(f)
+        f.seek(0)
+        try:
+            r = await db.run(import_csv, f, replace)
+        except (ValueError, psycopg2.DataError) as e:
+            await msg.reply_text(f"❌ Import failed, nothing was changed: {e}")
+            return
+    if r["kind"] == "keys":
+        await expiry_scheduler.reload()
+    await refresh_after_import({r["kind"]})
+    await msg.reply_text(import_report(doc.file_name or "import", r))
+
+async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    await send_export(update, EXPORT_KEYS, KEYS_HEADER, "keys_backup")
 
 async def migratealias(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
@@ -463,29 +3103,68 @@ async def migratealias(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /migratealias <old> <new>")
         return
     old, new = context.args
-    cur.execute("UPDATE aliases SET channel_id = %s WHERE alias = %s", (new, old))
-    cur.execute("UPDATE groups SET alias = %s WHERE alias = %s", (new, old))
-    conn.commit()
+
+    def migrate(cur):
+        cur.execute("UPDATE aliases SET channel_id = %s WHERE alias = %s", (new, old))
+        cur.execute("UPDATE groups SET alias = %s WHERE alias = %s", (new, old))
+
+    await db.run(migrate)
+    await alias_cache.invalidate()
     await update.message.reply_text(f"🔁 Alias `{old}` migrated to `{new}`", parse_mode="Markdown")
 
+WHOHAS_SQL = """
+    WITH matches AS (
+        SELECT DISTINCT c.key FROM key_channels c WHERE c.channel = ANY(%(channels)s)
+    )
+    SELECT k.key, k.bound_user, k.revoked, (SELECT COUNT(*) FROM matches)
+    FROM matches m JOIN keys k ON k.key = m.key
+    WHERE {where}
+    ORDER BY k.key {order} LIMIT %(limit)s
+"""
+
+ARCHIVE_WHOHAS_SQL = """
+    WITH matches AS (
+        SELECT key, bound_user, revoked FROM key_archive WHERE channels && %(channels)s::text[]
+    )
+    SELECT k.key, k.bound_user, k.revoked, (SELECT COUNT(*) FROM matches)
+    FROM matches k
+    WHERE {where}
+    ORDER BY k.key {order} LIMIT %(limit)s
+"""
+
+async def whohas_page(target, cursor=None, backwards=False, archive=False):
+    # Each name matches both itself and the channel it aliases.
+    names = await alias_cache.expand(target)
+    channels = set(names) | set(await alias_cache.resolve(target))
+    where = "TRUE" if cursor is None else ("k.key < %(cursor)s" if backwards else "k.key > %(cursor)s")
+    sql = ARCHIVE_WHOHAS_SQL if archive else WHOHAS_SQL
+    rows = await db.fetchall(sql.format(where=where, order="DESC" if backwards else "ASC"),
+                             {"channels": list(channels), "cursor": cursor, "limit": PAGE_SIZE + 1})
+    rows, has_prev, has_next = page_rows(rows, cursor, backwards)
+    if not rows:
+        return "No users found.", None
+    total = rows[0][3]
+    out = f"{'🗄️' if archive else '👥'} {target}: {total} {'archived ' if archive else ''}key(s)\n"
+    out += "".join(f"{k} → {uid}{' ❌' if r else ''}\n" for k, uid, r, _ in rows)
+    return out, page_markup("wa" if archive else "wh", target, rows, has_prev, has_next)
+
 async def whohas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    if len(context.args) != 1:
-        await update.message.reply_text("Usage: /whohas <alias/group>")
+    if not context.args or context.args[1:] not in ([], ["archive"]):
+        await update.message.reply_text("Usage: /whohas <alias/group> [archive]")
         return
-    target = context.args[0]
-    cur.execute("SELECT alias FROM groups WHERE group_name = %s", (target,))
-    group_rows = cur.fetchall()
-    aliases = [target] if not group_rows else [r[0] for r in group_rows]
+    out, markup = await whohas_page(context.args[0], archive=len(context.args) == 2)
+    await update.message.reply_text(out, reply_markup=markup)
 
-    cur.execute("SELECT key, bound_user FROM keys")
-    out = ""
-    for k, uid in cur.fetchall():
-        cur.execute("SELECT channels FROM keys WHERE key = %s", (k,))
-        ch = cur.fetchone()[0].split("+")
-        if any(a in ch for a in aliases):
-            out += f"{k} → {uid}\n"
-    await update.message.reply_text(out or "No users found.")
+async def whohas_nav(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        await query.answer()
+        return
+    tag, direction, cursor, target = query.data.split("|", 3)
+    out, markup = await whohas_page(target, cursor, backwards=direction == "<", archive=tag == "wa")
+    await query.answer()
+    await query.edit_message_text(out, reply_markup=markup)
 
 async def renew(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
@@ -493,14 +3172,14 @@ async def renew(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /renew <KEY> <1d2h or L>")
         return
     k, duration = context.args
-    cur.execute("SELECT key FROM keys WHERE key = %s", (k,))
-    if not cur.fetchone():
+    td = parse_duration(duration)
+    expiry = utcnow() + td if td else None
+    row = await db.fetchone("UPDATE keys SET expiry = %s, duration = NULL, reminded_at = NULL WHERE key = %s RETURNING bound_user", (expiry, k))
+    if not row:
         await update.message.reply_text("❌ Key does not exist. Cannot renew.")
         return
-    td = parse_duration(duration)
-    expiry = (datetime.utcnow() + td).isoformat() if td else None
-    cur.execute("UPDATE keys SET expiry = %s WHERE key = %s", (expiry, k))
-    conn.commit()
+    expiry_scheduler.schedule(k, expiry)
+    await entitlements.invalidate([row[0]])
     await update.message.reply_text("🔁 Key renewed successfully.")
 
 async def renewall(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -510,10 +3189,11 @@ async def renewall(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     dur = context.args[0]
     td = parse_duration(dur)
-    expiry = (datetime.utcnow() + td).isoformat() if td else None
-    cur.execute("UPDATE keys SET expiry = %s WHERE revoked = 0", (expiry,))
-    conn.commit()
-    await update.message.reply_text(f"🔁 All active keys renewed with expiry: `{expiry or 'Lifetime'}`", parse_mode="Markdown")
+    expiry = utcnow() + td if td else None
+    await db.execute("UPDATE keys SET expiry = %s, duration = NULL, reminded_at = NULL WHERE NOT revoked", (expiry,))
+    await entitlements.clear()
+    await expiry_scheduler.reload()
+    await update.message.reply_text(f"🔁 All active keys renewed with expiry: `{format_expiry(expiry, lifetime='Lifetime')}`", parse_mode="Markdown")
 
 async def addkey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
@@ -524,9 +3204,10 @@ async def addkey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     duration = context.args[1]
     aliases = context.args[2] if len(context.args) > 2 else ""
     td = parse_duration(duration)
-    expiry = (datetime.utcnow() + td).isoformat() if td else None
-    cur.execute("INSERT INTO keys VALUES (%s, %s, %s, %s, %s)", (custom_key, aliases, None, expiry, 0))
-    conn.commit()
+    expiry = utcnow() + td if td else None
+    await db.run(insert_key, custom_key, aliases.split("+"), expiry)
+    await key_filter.added([custom_key])
+    expiry_scheduler.schedule(custom_key, expiry)
     await update.message.reply_text(f"✅ Custom key `{custom_key}` created.", parse_mode="Markdown")
 
 async def resetbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -536,40 +3217,34 @@ async def resetbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def confirmreset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     # Export everything
+    await send_export(update, EXPORT_KEYS, ['Key', 'Channels', 'BoundUser', 'Expiry', 'Revoked'], "keys_backup")
+    await send_export(update, "SELECT alias, channel_id FROM aliases", ['Alias', 'Channel ID'], "aliases_backup")
+    await send_export(update, "SELECT group_name, alias FROM groups", ['Group Name', 'Alias'], "groups_backup")
     tables = ['keys', 'aliases', 'groups']
-    for table in tables:
-        cur.execute(f"SELECT * FROM {table}")
-        rows = cur.fetchall()
-        output = io.StringIO()
-        writer = csv.writer(output)
-        if table == 'keys':
-            writer.writerow(['Key', 'Channels', 'BoundUser', 'Expiry', 'Revoked'])
-        elif table == 'aliases':
-            writer.writerow(['Alias', 'Channel ID'])
-        elif table == 'groups':
-            writer.writerow(['Group Name', 'Alias'])
-        writer.writerows(rows)
-        output.seek(0)
-        await update.message.reply_document(document=output.getvalue(), filename=f"{table}_backup.csv")
     
     # Clear all data
-    for table in tables:
-        cur.execute(f"DELETE FROM {table}")
-    conn.commit()
+
+    def wipe(cur):
+        for table in tables:
+            cur.execute(f"DELETE FROM {table}")
+
+    await db.run(wipe)
+    await alias_cache.invalidate()
+    await entitlements.clear()
     await update.message.reply_text("🧨 Bot reset completed. All data wiped.")
 
 # Multi-admin support
 async def addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS: return
+    if update.effective_user.id not in settings.admins: return
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /addadmin <user_id>")
         return
     uid = int(context.args[0])
-    ADMINS.add(uid)
+    await settings.set_admin(uid, True)
     await update.message.reply_text(f"✅ User `{uid}` added to admin list.", parse_mode="Markdown")
 
 async def rmadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS: return
+    if update.effective_user.id not in settings.admins: return
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /rmadmin <user_id>")
         return
@@ -577,80 +3252,110 @@ async def rmadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if uid == ADMIN_ID:
         await update.message.reply_text("❌ Cannot remove the root admin.")
         return
-    ADMINS.discard(uid)
+    await settings.set_admin(uid, False)
     await update.message.reply_text(f"🗑️ User `{uid}` removed from admins.", parse_mode="Markdown")
 
 async def admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS: return
-    out = "\n".join([f"👑 {uid}" for uid in ADMINS])
+    if update.effective_user.id not in settings.admins: return
+    out = "\n".join([f"👑 {uid}" for uid in sorted(settings.admins)])
     await update.message.reply_text(f"📋 *Current Admins:*\n{out}", parse_mode="Markdown")
 
 # Lock/Unlock
 async def lockbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global LOCKED
-    if update.effective_user.id not in ADMINS: return
-    LOCKED = True
+    if update.effective_user.id not in settings.admins: return
+    await settings.set("locked", "1")
     await update.message.reply_text("🚫 Bot is now LOCKED. Users cannot use /use command.")
 
 async def unlockbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global LOCKED
-    if update.effective_user.id not in ADMINS: return
-    LOCKED = False
+    if update.effective_user.id not in settings.admins: return
+    await settings.set("locked", "0")
     await update.message.reply_text("✅ Bot is now UNLOCKED. Users can redeem keys again.")
 
 async def maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS: return
+    if update.effective_user.id not in settings.admins: return
     msg = "🚧 We’re performing maintenance. Some features may be unavailable temporarily."
     if context.args:
         msg += "\n" + " ".join(context.args)
-    cur.execute("SELECT DISTINCT bound_user FROM keys WHERE bound_user IS NOT NULL")
-    for row in cur.fetchall():
-        try:
-            await context.bot.send_message(row[0], msg)
-        except: pass
-    await update.message.reply_text("📢 Maintenance message sent to all users.")
+    queued, = await start_batch(update, "📢 maintenance", message_all_users, msg)
+    await update.message.reply_text(f"📢 Maintenance message queued for {queued} users.")
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    if not context.args:
+        await update.message.reply_text("Usage: /broadcast <message>")
+        return
+    msg = update.message.text.split(None, 1)[1]
+    queued, = await start_batch(update, "📣 broadcast", message_all_users, msg)
+    await update.message.reply_text(f"📣 Broadcasting to {queued} users...")
 
 
 
 
 
 # === REGISTER HANDLERS ===
-dispatcher.add_handler(CommandHandler("start", start))
-dispatcher.add_handler(CommandHandler("help", help_cmd))
-dispatcher.add_handler(CommandHandler("contact", contact))
-dispatcher.add_handler(CommandHandler("mykey", mykey))
-dispatcher.add_handler(CommandHandler("use", use))
-dispatcher.add_handler(CommandHandler("genkey", genkey))
-dispatcher.add_handler(CommandHandler("extend", extend))
-dispatcher.add_handler(CommandHandler("extendall", extendall))
-dispatcher.add_handler(CommandHandler("broadcast", broadcast))
-dispatcher.add_handler(CommandHandler("remind3", remind3))
-dispatcher.add_handler(CommandHandler("setalias", setalias))
-dispatcher.add_handler(CommandHandler("deletealias", deletealias))
-dispatcher.add_handler(CommandHandler("listaliases", listaliases))
-dispatcher.add_handler(CommandHandler("setgroup", setgroup))
-dispatcher.add_handler(CommandHandler("listgroups", listgroups))
-dispatcher.add_handler(CommandHandler("revoke", revoke))
-dispatcher.add_handler(CommandHandler("revokeall", revokeall))
-dispatcher.add_handler(CommandHandler("keyinfo", keyinfo))
-dispatcher.add_handler(CommandHandler("clearkeys", clearkeys))
-dispatcher.add_handler(CommandHandler("listkeys", listkeys))
-dispatcher.add_handler(CommandHandler("exportkeys", exportkeys))
-dispatcher.add_handler(CommandHandler("setadmin", setadmin))
-dispatcher.add_handler(CommandHandler("purgeexpired", purgeexpired))
-dispatcher.add_handler(CommandHandler("renewall", renewall))
-dispatcher.add_handler(CommandHandler("addkey", addkey))
-dispatcher.add_handler(CommandHandler("resetbot", resetbot))
-dispatcher.add_handler(CommandHandler("confirmreset", confirmreset))
-dispatcher.add_handler(CommandHandler("lockbot", lockbot))
-dispatcher.add_handler(CommandHandler("unlockbot", unlockbot))
-dispatcher.add_handler(CommandHandler("maintenance", maintenance))
-dispatcher.add_handler(CommandHandler("addadmin", addadmin))
-dispatcher.add_handler(CommandHandler("rmadmin", rmadmin))
-dispatcher.add_handler(CommandHandler("admins", admins))
+application.add_handler(CommandHandler("start", start))
+application.add_handler(CommandHandler("help", help_cmd))
+application.add_handler(CommandHandler("contact", contact))
+application.add_handler(CommandHandler("mykey", mykey))
+application.add_handler(CommandHandler("use", use))
+application.add_handler(CommandHandler("genkey", genkey))
+application.add_handler(CommandHandler("extend", extend))
+application.add_handler(CommandHandler("extendall", extendall))
+application.add_handler(CommandHandler("broadcast", broadcast))
+application.add_handler(CommandHandler("remind3", remind3))
+application.add_handler(CommandHandler("setalias", setalias))
+application.add_handler(CommandHandler("deletealias", deletealias))
+application.add_handler(CommandHandler("listaliases", listaliases))
+application.add_handler(CommandHandler("setgroup", setgroup))
+application.add_handler(CommandHandler("listgroups", listgroups))
+application.add_handler(CommandHandler("revoke", revoke))
+application.add_handler(CommandHandler("revokeall", revokeall))
+application.add_handler(CommandHandler("keyinfo", keyinfo))
+application.add_handler(CommandHandler("clearkeys", clearkeys))
+application.add_handler(CommandHandler("listkeys", listkeys))
+application.add_handler(CommandHandler("exportkeys", exportkeys))
+application.add_handler(CommandHandler("setadmin", setadmin))
+application.add_handler(CommandHandler("purgeexpired", purgeexpired))
+application.add_handler(CommandHandler("renewall", renewall))
+application.add_handler(CommandHandler("addkey", addkey))
+application.add_handler(CommandHandler("resetbot", resetbot))
+application.add_handler(CommandHandler("confirmreset", confirmreset))
+application.add_handler(CommandHandler("lockbot", lockbot))
+application.add_handler(CommandHandler("unlockbot", unlockbot))
+application.add_handler(CommandHandler("maintenance", maintenance))
+application.add_handler(CommandHandler("addadmin", addadmin))
+application.add_handler(CommandHandler("rmadmin", rmadmin))
+application.add_handler(CommandHandler("admins", admins))
+application.add_handler(CommandHandler("poolstats", poolstats))
+application.add_handler(CommandHandler("queuestats", queuestats))
+application.add_handler(CommandHandler("evictions", evictions))
+application.add_handler(CommandHandler("jobs", jobs))
+application.add_handler(CommandHandler("joinlinks", joinlinks))
+application.add_handler(CommandHandler("members", members))
+application.add_handler(CommandHandler("archive", archive))
+application.add_handler(CommandHandler("whohas", whohas))
+application.add_handler(CommandHandler("migratealias", migratealias))
+application.add_handler(CallbackQueryHandler(whohas_nav, pattern=r"^w[ha]\|"))
+application.add_handler(CallbackQueryHandler(listkeys_nav, pattern=r"^lk\|"))
+application.add_handler(CommandHandler("backup", backup))
+application.add_handler(CommandHandler("importkeys", importkeys))
+application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/importkeys\b"), importkeys))
+application.add_handler(CommandHandler("stats", stats))
+application.add_handler(CommandHandler("renew", renew))
+application.add_handler(ChatJoinRequestHandler(join_request))
+application.add_handler(ChatMemberHandler(chat_member, ChatMemberHandler.CHAT_MEMBER))
+
+# Wraps every handler registered above with latency and query telemetry.
+for handlers in application.handlers.values():
+    for h in handlers:
+        h.callback = instrument(min(h.commands) if isinstance(h, CommandHandler) else h.callback.__name__, h.callback)
 
 
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=PORT)
+    if sys.argv[1:2] == ["importkeys"]:
+        import_cli(sys.argv[2:])
+        sys.exit()
+    start_runtime(wait=False)
+    app.run(host="0.0.0.0", port=PORT, threaded=True)